@@ -1,114 +1,46 @@
+import argparse
+import atexit
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 from tkinter import messagebox
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, func
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import tkinter.ttk as ttk
 
-# Database setup
-engine = create_engine('sqlite:///election.db')
-Base = declarative_base()
-Session = sessionmaker(bind=engine)
-session = Session()
-
-# Define database tables
-class Voter(Base):
-    __tablename__ = 'voter'
-    id = Column(Integer, primary_key=True)
-    account = Column(String, unique=True, nullable=False)
-    password = Column(String, nullable=False)
-    has_voted = Column(Boolean, default=False)
-    site = Column(String, nullable=True)  # Change site column type to String
-    age = Column(Integer, nullable=True)  # Add age column
-
-
-class Vote(Base):
-    __tablename__ = 'vote'
-    id = Column(Integer, primary_key=True)
-    voter_id = Column(Integer, ForeignKey('voter.id'), nullable=False)
-    candidate_id = Column(Integer, ForeignKey('candidate.id'), nullable=False)
-    voter = relationship('Voter')
-    candidate = relationship('Candidate')
-
-class Admin(Base):
-    __tablename__ = 'admin'
-    id = Column(Integer, primary_key=True)
-    account = Column(String, unique=True, nullable=False)
-    password = Column(String, nullable=False)
-
-class Candidate(Base):
-    __tablename__ = 'candidate'
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
-    party = Column(String, nullable=False)
-
-# Create database tables
-Base.metadata.create_all(engine)
-
-# Check if candidates exist in the database, if not, add them
-candidates_info = [
-    {"name": "Kennedy", "party": "Party A"},
-    {"name": "Biden", "party": "Party B"},
-    {"name": "Trump", "party": "Party C"},
-    {"name": "Putin", "party": "Party D"},
-    {"name": "Macron", "party": "Party E"}
-]
-
-existing_candidate_names = [candidate.name for candidate in session.query(Candidate).all()]
-
-for data in candidates_info:
-    if data["name"] not in existing_candidate_names:
-        candidate = Candidate(name=data["name"], party=data["party"] )
-        session.add(candidate)
-
-    # Add preset voter information
-pre_defined_voters_info = [
-        {"account": "a1", "password": "1", "age": 25, "has_voted": False, "site": 1},
-        {"account": "b2", "password": "2", "age": 30, "has_voted": False, "site": 2},
-        {"account": "c3", "password": "3", "age": 22, "has_voted": False, "site": 3},
-        {"account": "d4", "password": "4", "age": 25, "has_voted": False, "site": 5},
-        {"account": "e5", "password": "5", "age": 25, "has_voted": False, "site": 1},
-        {"account": "f6", "password": "6", "age": 34, "has_voted": False, "site": 2},
-        {"account": "g7", "password": "7", "age": 45, "has_voted": False, "site": 4},
-        {"account": "h8", "password": "8", "age": 25, "has_voted": False, "site": 1},
-        {"account": "i9", "password": "9", "age": 36, "has_voted": False, "site": 7},
-        {"account": "j10", "password": "10", "age": 30, "has_voted": False, "site": 8},
-        {"account": "k11", "password": "11", "age": 31, "has_voted": False, "site": 1},
-        {"account": "l12", "password": "12", "age": 27, "has_voted": False, "site": 1},
-        {"account": "m13", "password": "13", "age": 28, "has_voted": False, "site": 3},
-        {"account": "n14", "password": "14", "age": 29, "has_voted": False, "site": 6},
-        {"account": "015", "password": "15", "age": 36, "has_voted": False, "site": 6}
-
-    ]
-
-for data in pre_defined_voters_info:
-    existing_voter = session.query(Voter).filter_by(account=data["account"]).first()
-    if existing_voter:
-        # If the same account name already exists, the current loop is skipped without the insertion
-        continue
-
-    voter = Voter(account=data["account"], password=data["password"], age=data["age"], has_voted=data["has_voted"],
-                  site=data["site"])
-    session.add(voter)
-
-
-session.commit()
-
-# Predefined admin account
-admin_account = "admin"
-admin_password = "admin"
+from election_charts import ChartManager
+from election_api import ElectionApiClient, run_api_server
+from election_audit import AuditLog, verify_audit_log
+from election_export import EXPORT_FORMATS, EXPORTS, export_data
+from election_metrics import metrics
+from election_service import (SCHEMA_VERSION, SITE_MAP, DatabaseConfig, ElectionService, ServiceError, VoteIngestor,
+                              apply_dashboard_changes, check_query_plans, configure_database, init_database,
+                              import_voters, migrate_passwords, rebuild_tallies, schema_version, session_scope)
+from election_shards import ShardedVoteStore
 
 # GUI setup
+VOTE_RECORDS_PAGE_SIZE = 200
+
 class ElectionSystem:
-    def __init__(self, root):
+    def __init__(self, root, service=None, refresh_interval_ms=2000, live_dashboard=False,
+                 metrics_file='election_metrics.json'):
         self.root = root
         self.root.title("Election System")
-        self.logged_in_user = None  # Store the logged-in user's account here
-        self.site_map = {"Site 1": 1, "Site 2": 2, "Site 3": 3, "Site 4": 4, "Site 5": 5, "Site 6": 6, "Site 7": 7,
-                         "Site 8": 8}  # Mapping of site strings to integers
+        # Either the in-process ElectionService or an ElectionApiClient talking to a running API server
+        self.service = service or ElectionService()
+        self.logged_in_user = None  # Store the logged-in user's details (as returned by the service) here
+        self.charts = ChartManager(self.root)
+        # Live dashboard: the database work runs on a background thread, the Tk thread only polls for its result
+        self.refresh_interval_ms = refresh_interval_ms
+        self.live_dashboard = tk.BooleanVar(self.root, value=live_dashboard)
+        self._dashboard = None
+        self._dashboard_job = None
+        self._result_labels = []
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dashboard-refresh')
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.site_map = dict(SITE_MAP)  # Mapping of site strings to integers
+        self.metrics_file = metrics_file  # Where the Diagnostics panel saves the metrics
         self.create_login_screen()
 
+    @metrics.timed('screen')
     def create_login_screen(self):
         self.clear_screen()
         tk.Label(self.root, text="account:").grid(row=0, column=0)
@@ -118,32 +50,44 @@ class ElectionSystem:
         tk.Label(self.root, text="If you have any questions, please contact 4008-823-823").grid(row=4, column=0,
                                                                                                 columnspan=2)
 
-        total_registered = session.query(func.count(Voter.id)).scalar()
-        total_voted = session.query(func.count(Voter.id)).filter_by(has_voted=True).scalar()
-        total_not_voted = total_registered - total_voted
-        # Shows the number of registrations and votes cast
-        tk.Label(self.root, text=f"Total registered: {total_registered}").grid(row=2, column=0, columnspan=2)
-        tk.Label(self.root, text=f"Total voted: {total_voted}").grid(row=3, column=0, columnspan=2)
-        # Create a pie chart
-        labels = ['Voted', 'Not Voted']
-        sizes = [total_voted, total_not_voted]
-        fig, ax = plt.subplots(figsize=(2, 2))
-        ax.pie(sizes, labels=labels, autopct='%1.1f%%')
-        ax.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-        plt.subplots_adjust(left=0.2, right=0.8, top=0.8, bottom=0.2)  # Resize the pie chart
-
-        # Display the pie chart on the login screen
-        canvas = FigureCanvasTkAgg(fig, master=self.root)
-        canvas.draw()
-        canvas.get_tk_widget().grid(row=7, column=0, columnspan=2)
+        # Shows the number of registrations and votes cast. The screen is usable straight away; the counts and the pie
+        # chart are filled in when the query returns.
+        self.turnout_labels = (tk.Label(self.root, text="Total registered: ..."),
+                               tk.Label(self.root, text="Total voted: ..."))
+        self.turnout_labels[0].grid(row=2, column=0, columnspan=2)
+        self.turnout_labels[1].grid(row=3, column=0, columnspan=2)
+        self._run_in_background(self.service.turnout, (), self._show_login_turnout)
 
         self.account_entry = tk.Entry(self.root)
         self.password_entry = tk.Entry(self.root, show='*')
         self.account_entry.grid(row=0, column=1)
         self.password_entry.grid(row=1, column=1)
-        tk.Button(self.root, text="Login", command=self.login).grid(row=5, column=0, columnspan=2)
+        self.login_button = tk.Button(self.root, text="Login", command=self.login)
+        self.login_button.grid(row=5, column=0, columnspan=2)
         tk.Button(self.root, text="Register", command=self.create_register_screen).grid(row=6, column=0, columnspan=2)
 
+    @metrics.timed('screen')
+    def _show_login_turnout(self, future):
+        registered_label, voted_label = self.turnout_labels
+        if not registered_label.winfo_exists():
+            return  # The login screen has already been left
+        try:
+            turnout = future.result()
+        except Exception:
+            return  # Leave the placeholders; the counts are only informational
+        total_registered, total_voted = turnout["registered"], turnout["voted"]
+        total_not_voted = total_registered - total_voted
+        registered_label.config(text=f"Total registered: {total_registered}")
+        voted_label.config(text=f"Total voted: {total_voted}")
+        # Create a pie chart
+        labels = ['Voted', 'Not Voted']
+        sizes = [total_voted, total_not_voted]
+        # Display the pie chart on the login screen (resized so it fits)
+        self.charts.pie('login_turnout', labels, sizes, figsize=(2, 2),
+                        subplots_adjust=dict(left=0.2, right=0.8, top=0.8, bottom=0.2)).grid(row=7, column=0,
+                                                                                              columnspan=2)
+
+    @metrics.timed('screen')
     def create_register_screen(self):
         self.clear_screen()
         tk.Label(self.root, text="account:").grid(row=0, column=0)
@@ -158,119 +102,145 @@ class ElectionSystem:
         self.password_entry.grid(row=1, column=1)
         self.age_entry.grid(row=2, column=1)  # Displays the age field
         self.site_combobox.grid(row=3, column=1)  # Displays a drop-down menu for site selection
-        tk.Button(self.root, text="Register", command=self.register).grid(row=4, column=0, columnspan=2)
+        self.register_button = tk.Button(self.root, text="Register", command=self.register)
+        self.register_button.grid(row=4, column=0, columnspan=2)
 
+    @metrics.timed('screen')
     def create_vote_screen(self):
         self.clear_screen()
 
         tk.Label(self.root, text="Vote Eligibility:").grid(row=0, column=0, columnspan=2)
-        if not self.logged_in_user or not isinstance(self.logged_in_user, Voter):
+        if not self.logged_in_user or self.logged_in_user["role"] != "voter":
             tk.Label(self.root, text="You are not logged in as a voter.").grid(row=1, column=0, columnspan=2)
-        elif self.logged_in_user.has_voted:
+        elif self.logged_in_user["has_voted"]:
             tk.Label(self.root, text="You have already voted.").grid(row=1, column=0, columnspan=2)
         else:
             tk.Label(self.root, text="You are eligible to vote.").grid(row=1, column=0, columnspan=2)
 
         tk.Label(self.root, text="Select Candidate:").grid(row=2, column=0)
 
-        candidates = session.query(Candidate).all()
+        candidates = self.service.candidates()
         self.selected_candidate_id = tk.IntVar()
         row = 3
         for candidate in candidates:
-            tk.Radiobutton(self.root, text=f"{candidate.name} - {candidate.party}", variable=self.selected_candidate_id,
-                           value=candidate.id).grid(
+            # The Vote button stays disabled until a candidate is picked
+            tk.Radiobutton(self.root, text=f"{candidate['name']} - {candidate['party']}",
+                           variable=self.selected_candidate_id, value=candidate['id'],
+                           command=lambda: self.vote_button.config(state=tk.NORMAL)).grid(
                 row=row, column=0, sticky=tk.W)
             row += 1
 
-        tk.Button(self.root, text="Vote", command=self.vote).grid(row=row, column=0, columnspan=2)
+        self.vote_button = tk.Button(self.root, text="Vote", command=self.vote, state=tk.DISABLED)
+        self.vote_button.grid(row=row, column=0, columnspan=2)
 
+    @metrics.timed('screen')
     def create_results_screen(self):
         self.clear_screen()
-        votes = session.query(Vote.candidate_id, func.count(Vote.candidate_id)).group_by(Vote.candidate_id).all()
-        candidate_names = []
-        vote_counts = []
-
-        for candidate_id, count in votes:
-            candidate = session.query(Candidate).filter_by(id=candidate_id).first()
-            candidate_names.append(candidate.name)
-            vote_counts.append(count)
-
-        fig, ax = plt.subplots()
-        ax.bar(candidate_names, vote_counts)
-        ax.set_ylabel('Votes')
-        ax.set_xlabel('Candidates')
-        ax.set_title('Election Results')
-
-        # Convert Matplotlib figure to Tkinter compatible format
-        canvas = FigureCanvasTkAgg(fig, master=self.root)
-        canvas.draw()
-        canvas.get_tk_widget().pack()
+        results = self.service.results()
+        candidate_names = [result['name'] for result in results]
+        vote_counts = [result['votes'] for result in results]
+
+        self.charts.bar('results', candidate_names, vote_counts, title='Election Results', xlabel='Candidates',
+                        ylabel='Votes').pack()
+
+    def _run_in_background(self, function, args, on_done):
+        # Runs function(*args) on the background thread and hands the finished future to on_done on the Tk thread.
+        # on_done must handle any exception from future.result(), not only ServiceError (a dropped connection to
+        # the API server, a locked database), since nothing else catches it on the Tk thread.
+        future = self._background.submit(metrics.call, f"background:{function.__name__}", function, *args)
+
+        def poll():
+            if future.done():
+                on_done(future)
+            else:
+                self.root.after(20, poll)
+        self.root.after(20, poll)
 
+    @staticmethod
+    def _error_text(error):
+        # ServiceError messages are meant for the user as they are
+        return str(error) if isinstance(error, ServiceError) else f"Unexpected error: {error!r}"
+
+    @metrics.timed('action')
     def login(self):
         account = self.account_entry.get()
         password = self.password_entry.get()
-        if account == admin_account and password == admin_password:
-            # If the account name and password you entered match the default administrator account name and password
-            messagebox.showinfo("Welcome", "Welcome back, administrator")
-            self.create_admin_dashboard_screen()
+        # Checking a password hash takes real CPU time, so keep it off the Tk thread
+        self.login_button.config(state=tk.DISABLED)
+        self._run_in_background(self.service.login, (account, password), self._finish_login)
+
+    @metrics.timed('action')
+    def _finish_login(self, future):
+        if self.login_button.winfo_exists():
+            self.login_button.config(state=tk.NORMAL)
+        try:
+            user = future.result()
+        except Exception as e:
+            messagebox.showerror("Login Error", self._error_text(e))
             return
-        # If it is not an administrator account, proceed to check the records in the database
-        user = session.query(Voter).filter_by(account=account).first() or session.query(Admin).filter_by(
-            account=account).first()
-        if user and user.password == password:
-            self.logged_in_user = user
-            if isinstance(user, Voter):
-                self.create_vote_screen()
-            else:
-                self.create_admin_dashboard_screen()
+        self.logged_in_user = user
+        if user["role"] == "voter":
+            self.create_vote_screen()
         else:
-            messagebox.showerror("Login Error", "Invalid account or password")
+            messagebox.showinfo("Welcome", "Welcome back, administrator")
+            self.create_admin_dashboard_screen()
 
+    @metrics.timed('action')
     def register(self):
-        account = self.account_entry.get()
-        password = self.password_entry.get()
-        age_str = self.age_entry.get()  # Gets the age entered by the user
-
-        # Check that the age matches the format
-        age_is_valid = age_str.isdigit()
-        if not age_is_valid:
-            messagebox.showerror("Registration Error", "Age must be a valid integer.")
-            return
-
-        age = int(age_str)
-
-        # Check if the age is under 18
-        if age < 18:
-            messagebox.showerror("Registration Error", "You must be 18 years or older to register.")
-            return
         # Gets the site selected by the user and converts to an integer value
-        site = self.site_map[self.site_combobox.get()]
-        # Add site and age information to the newly registered voter object
-        new_voter = Voter(account=account, password=password, site=site, age=age)
-        session.add(new_voter)
-        session.commit()
+        site = self.site_map.get(self.site_combobox.get())
+        # The service checks the age format, the minimum age and that the account is free. Hashing the password
+        # takes real CPU time, so this runs off the Tk thread like login.
+        self.register_button.config(state=tk.DISABLED)
+        self._run_in_background(self.service.register, (self.account_entry.get(), self.password_entry.get(),
+                                                        self.age_entry.get(), site), self._finish_register)
+
+    @metrics.timed('action')
+    def _finish_register(self, future):
+        if self.register_button.winfo_exists():
+            self.register_button.config(state=tk.NORMAL)
+        try:
+            future.result()
+        except Exception as e:
+            messagebox.showerror("Registration Error", self._error_text(e))
+            return
         messagebox.showinfo("Registration Success", "Registration Success")
         self.create_login_screen()
 
+    @metrics.timed('action')
     def vote(self):
         candidate_id = self.selected_candidate_id.get()
 
         # Checks if the user has voted
-        if self.logged_in_user and isinstance(self.logged_in_user, Voter) and not self.logged_in_user.has_voted:
-            # Record the vote
-            new_vote = Vote(voter_id=self.logged_in_user.id, candidate_id=candidate_id)
-            self.logged_in_user.has_voted = True
-            session.add(new_vote)
-            session.commit()
-            messagebox.showinfo("Vote Success", "Vote Success")
-            self.create_results_screen()  # Results are displayed after voting
+        if self.logged_in_user and self.logged_in_user["role"] == "voter" and not self.logged_in_user["has_voted"]:
+            # Record the vote off the Tk thread: it returns only once the ballot has been committed (a group commit,
+            # or a round trip to the API server)
+            self.vote_button.config(state=tk.DISABLED)
+            self._run_in_background(self.service.vote, (self.logged_in_user["id"], candidate_id), self._finish_vote)
         else:
             messagebox.showerror("Vote Error", "You have already voted")
 
+    @metrics.timed('action')
+    def _finish_vote(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            if self.vote_button.winfo_exists():
+                self.vote_button.config(state=tk.NORMAL)
+            messagebox.showerror("Vote Error", self._error_text(e))
+            return
+        self.logged_in_user["has_voted"] = True
+        messagebox.showinfo("Vote Success", "Vote Success")
+        self.create_results_screen()  # Results are displayed after voting
+
+    @metrics.timed('screen')
     def create_admin_dashboard_screen(self):
         self.clear_screen()
         tk.Label(self.root, text="administrator", font=("Helvetica", 16)).grid(row=0, column=0, columnspan=2)
 
+        # Everything below is drawn from one snapshot, which the live mode then keeps up to date
+        self._dashboard = self.service.dashboard_snapshot()
+
         # Shows the current voting results
         self.show_current_results()
 
@@ -287,29 +257,273 @@ class ElectionSystem:
 
         # Add a button to view voting records
         tk.Button(self.root, text="View Vote Records", command=self.show_vote_records).grid(row=0, column=4)
-
+        # Turnout and candidate share by site and age band
+        tk.Button(self.root, text="Demographics", command=self.show_demographics).grid(row=0, column=5)
+
+        # Refresh the counts and charts every refresh_interval_ms while this is ticked
+        tk.Checkbutton(self.root, text="Live updates", variable=self.live_dashboard,
+                       command=self._toggle_live_dashboard).grid(row=0, column=6)
+        # Query counts and timings of every screen and action
+        tk.Button(self.root, text="Diagnostics", command=self.show_diagnostics).grid(row=0, column=7)
+        if self.live_dashboard.get():
+            self._schedule_dashboard_refresh()
+
+    def _toggle_live_dashboard(self):
+        self._cancel_dashboard_refresh()
+        if self.live_dashboard.get():
+            self._schedule_dashboard_refresh()
+
+    def _schedule_dashboard_refresh(self):
+        self._dashboard_job = self.root.after(self.refresh_interval_ms, self._refresh_dashboard)
+
+    def _cancel_dashboard_refresh(self):
+        if self._dashboard_job is not None:
+            self.root.after_cancel(self._dashboard_job)
+            self._dashboard_job = None
+
+    @metrics.timed('action')
+    def _refresh_dashboard(self):
+        # Only fetch what was added since the snapshot; the query runs off the Tk thread
+        future = self._background.submit(metrics.call, "background:dashboard_changes", self.service.dashboard_changes,
+                                         self._dashboard["last_vote_id"], self._dashboard["last_voter_id"])
+        self._dashboard_job = self.root.after(50, self._apply_dashboard_changes, future)
+
+    def _apply_dashboard_changes(self, future):
+        if not future.done():
+            self._dashboard_job = self.root.after(50, self._apply_dashboard_changes, future)
+            return
+        try:
+            changes = future.result()
+        except Exception:
+            # The database or API server may be briefly unavailable; keep the last numbers and try again later
+            changes = None
+        dashboard = apply_dashboard_changes(self._dashboard, changes) if changes else self._dashboard
+        if dashboard != self._dashboard:
+            self._dashboard = dashboard
+            self.show_current_results()
+            self.show_current_results_bar_chart()
+            self.show_site_distribution_bar_and_vote_pie_chart()
+        self._schedule_dashboard_refresh()
+
+    @metrics.timed('screen')
     def show_vote_records(self):
+        # Shows one page of records at a time in a Treeview; Previous/Next fetch the neighbouring page by vote id
         self.vote_records_window = tk.Toplevel(self.root)
         self.vote_records_window.title("Vote Records")
+        window = self.vote_records_window
+
+        tk.Label(window, text="Vote Records", font=("Helvetica", 16)).grid(row=0, column=0, columnspan=4)
+
+        # Filters
+        self._record_candidates = {f"{candidate['name']} - {candidate['party']}": candidate['id']
+                                   for candidate in self.service.candidates()}
+        tk.Label(window, text="Site:").grid(row=1, column=0, sticky=tk.E)
+        self.records_site_combobox = ttk.Combobox(window, state='readonly',
+                                                  values=["All sites"] + list(self.site_map.keys()))
+        self.records_site_combobox.current(0)
+        self.records_site_combobox.grid(row=1, column=1, sticky=tk.W)
+        tk.Label(window, text="Candidate:").grid(row=1, column=2, sticky=tk.E)
+        self.records_candidate_combobox = ttk.Combobox(window, state='readonly',
+                                                       values=["All candidates"] + list(self._record_candidates))
+        self.records_candidate_combobox.current(0)
+        self.records_candidate_combobox.grid(row=1, column=3, sticky=tk.W)
+        for combobox in (self.records_site_combobox, self.records_candidate_combobox):
+            combobox.bind('<<ComboboxSelected>>', lambda event: self._load_vote_records())
+
+        # Only the current page is ever inserted into the tree
+        self.records_tree = ttk.Treeview(window, columns=('id', 'voter', 'candidate', 'site'), show='headings',
+                                         height=20)
+        for column, heading, width in (('id', "#", 80), ('voter', "Voter", 140), ('candidate', "Candidate", 140),
+                                       ('site', "Site", 60)):
+            self.records_tree.heading(column, text=heading)
+            self.records_tree.column(column, width=width, anchor=tk.W)
+        scrollbar = ttk.Scrollbar(window, orient=tk.VERTICAL, command=self.records_tree.yview)
+        self.records_tree.configure(yscrollcommand=scrollbar.set)
+        self.records_tree.grid(row=2, column=0, columnspan=4, sticky=tk.NSEW)
+        scrollbar.grid(row=2, column=4, sticky=tk.NS)
+
+        self.records_previous_button = tk.Button(window, text="< Previous",
+                                                 command=lambda: self._load_vote_records(before_id=self._records_first))
+        self.records_previous_button.grid(row=3, column=0)
+        self.records_page_label = tk.Label(window)
+        self.records_page_label.grid(row=3, column=1, columnspan=2)
+        self.records_next_button = tk.Button(window, text="Next >",
+                                             command=lambda: self._load_vote_records(after_id=self._records_last))
+        self.records_next_button.grid(row=3, column=3)
+        tk.Button(window, text="Close", command=window.destroy).grid(row=4, column=0, columnspan=4)
+
+        self._load_vote_records()
+
+    @metrics.timed('action')
+    def _load_vote_records(self, after_id=None, before_id=None):
+        # Fetched off the Tk thread (a filter that matches few votes walks many to fill a page); only the answer to
+        # the latest request is shown
+        site = self.site_map.get(self.records_site_combobox.get())
+        candidate_id = self._record_candidates.get(self.records_candidate_combobox.get())
+        self.records_previous_button.config(state=tk.DISABLED)
+        self.records_next_button.config(state=tk.DISABLED)
+        self._records_request = request = getattr(self, '_records_request', 0) + 1
+        self._run_in_background(self.service.vote_records, (after_id, before_id, VOTE_RECORDS_PAGE_SIZE, site,
+                                                            candidate_id),
+                                lambda future: self._show_vote_records_page(future, request))
+
+    @metrics.timed('screen')
+    def _show_vote_records_page(self, future, request):
+        if request != self._records_request or not self.records_tree.winfo_exists():
+            return
+        try:
+            page = future.result()  # Already anonymized by the service
+        except Exception as e:
+            self.records_page_label.config(text=self._error_text(e))
+            return
+        records = page["records"]
+
+        self.records_tree.delete(*self.records_tree.get_children())
+        for record in records:
+            self.records_tree.insert('', tk.END, values=(record['id'], record['voter'], record['candidate'],
+                                                         record['site']))
+
+        self._records_first = records[0]['id'] if records else None
+        self._records_last = records[-1]['id'] if records else None
+        self.records_previous_button.config(state=tk.NORMAL if records and page["has_previous"] else tk.DISABLED)
+        self.records_next_button.config(state=tk.NORMAL if records and page["has_next"] else tk.DISABLED)
+        if records:
+            self.records_page_label.config(text=f"Votes #{self._records_first} - #{self._records_last}")
+        else:
+            self.records_page_label.config(text="No votes")
+
+    @metrics.timed('screen')
+    def show_demographics(self):
+        # One tab per breakdown; the analytics are computed off the Tk thread and cached by the service
+        self.demographics_window = tk.Toplevel(self.root)
+        self.demographics_window.title("Demographics")
+        window = self.demographics_window
+
+        tk.Label(window, text="Demographics", font=("Helvetica", 16)).grid(row=0, column=0, columnspan=2)
+        self.demographics_notebook = ttk.Notebook(window)
+        self.demographics_notebook.grid(row=1, column=0, columnspan=2, sticky=tk.NSEW)
+        self.demographics_status = tk.Label(window)
+        self.demographics_status.grid(row=2, column=0, sticky=tk.W)
+        tk.Button(window, text="Refresh", command=self._load_demographics).grid(row=2, column=1, sticky=tk.E)
+        tk.Button(window, text="Close", command=window.destroy).grid(row=3, column=0, columnspan=2)
+
+        self._load_demographics()
+
+    def _load_demographics(self):
+        self.demographics_status.config(text="Loading...")
+        self._run_in_background(self.service.analytics, (), self._show_demographics)
+
+    @metrics.timed('screen')
+    def _show_demographics(self, future):
+        notebook = self.demographics_notebook
+        if not notebook.winfo_exists():
+            return  # The window was closed while loading
+        try:
+            analytics = future.result()
+        except Exception as e:
+            # Show the problem in the panel rather than leaving it on "Loading..."
+            self.demographics_status.config(text=self._error_text(e))
+            return
+        for tab in notebook.tabs():
+            notebook.nametowidget(tab).destroy()
+
+        site_names = {str(site): name for name, site in self.site_map.items()}
+        by_site = [dict(row, group=site_names.get(row["group"], row["group"] or "No site"))
+                   for row in analytics["by_site"]]
+        candidates = [candidate["name"] for candidate in analytics["candidates"]]
+        self._add_breakdown_tab("By site", "Site", by_site, candidates)
+        self._add_breakdown_tab("By age", "Age", analytics["by_age_band"], candidates)
+
+        # Turnout of every site and age band combination
+        frame = ttk.Frame(notebook)
+        bands = analytics["age_bands"]
+        tree = ttk.Treeview(frame, columns=['site'] + [f"band{i}" for i in range(len(bands))], show='headings',
+                            height=12)
+        tree.heading('site', text="Site")
+        tree.column('site', width=100, anchor=tk.W)
+        for i, band in enumerate(bands):
+            tree.heading(f"band{i}", text=band)
+            tree.column(f"band{i}", width=110, anchor=tk.E)
+        cross_tab = analytics["site_by_age_band"]
+        for row in range(len(by_site)):
+            tree.insert('', tk.END, values=[by_site[row]["group"]] + [
+                f"{voted}/{registered} ({self._percent(voted, registered)})"
+                for voted, registered in zip(cross_tab["voted"][row], cross_tab["registered"][row])])
+        tree.pack(fill=tk.BOTH, expand=True)
+        notebook.add(frame, text="Turnout by site and age")
+
+        total = sum(row["registered"] for row in by_site)
+        self.demographics_status.config(text=f"{total} voters, votes up to #{analytics['last_vote_id']}")
+
+    def _add_breakdown_tab(self, title, heading, rows, candidates):
+        # Registered, voted and turnout per group, then each candidate's share of that group's votes
+        frame = ttk.Frame(self.demographics_notebook)
+        columns = ['group', 'registered', 'voted', 'turnout'] + [f"candidate{i}" for i in range(len(candidates))]
+        tree = ttk.Treeview(frame, columns=columns, show='headings', height=12)
+        for column, text in zip(columns, [heading, "Registered", "Voted", "Turnout"] + candidates):
+            tree.heading(column, text=text)
+            tree.column(column, width=100 if column == 'group' else 80, anchor=tk.W if column == 'group' else tk.E)
+        for row in rows:
+            tree.insert('', tk.END, values=[row["group"], row["registered"], row["voted"],
+                                            self._percent(row["voted"], row["registered"])]
+                        + [self._percent(votes, row["voted"]) for votes in row["votes"]])
+        tree.pack(fill=tk.BOTH, expand=True)
+        self.demographics_notebook.add(frame, text=title)
+
+    @staticmethod
+    def _percent(part, whole):
+        return f"{100 * part / whole:.1f}%" if whole else "-"
+
+    def show_diagnostics(self):
+        # The operations recorded by election_metrics, slowest in total first
+        self.diagnostics_window = tk.Toplevel(self.root)
+        self.diagnostics_window.title("Diagnostics")
+        window = self.diagnostics_window
+
+        tk.Label(window, text="Diagnostics", font=("Helvetica", 16)).grid(row=0, column=0, columnspan=3)
+        columns = ('operation', 'calls', 'avg_ms', 'max_ms', 'total_ms', 'queries_per_call', 'sql_ms')
+        self.diagnostics_tree = ttk.Treeview(window, columns=columns, show='headings', height=20)
+        for column, heading, width in zip(columns, ("Operation", "Calls", "Avg ms", "Max ms", "Total ms",
+                                                    "Queries/call", "SQL ms"), (300, 60, 80, 80, 90, 90, 80)):
+            self.diagnostics_tree.heading(column, text=heading)
+            self.diagnostics_tree.column(column, width=width, anchor=tk.W if column == 'operation' else tk.E)
+        scrollbar = ttk.Scrollbar(window, orient=tk.VERTICAL, command=self.diagnostics_tree.yview)
+        self.diagnostics_tree.configure(yscrollcommand=scrollbar.set)
+        self.diagnostics_tree.grid(row=1, column=0, columnspan=3, sticky=tk.NSEW)
+        scrollbar.grid(row=1, column=3, sticky=tk.NS)
+        self.diagnostics_label = tk.Label(window)
+        self.diagnostics_label.grid(row=2, column=0, columnspan=3)
+
+        tk.Button(window, text="Refresh", command=self._load_diagnostics).grid(row=3, column=0)
+        tk.Button(window, text="Reset", command=self._reset_diagnostics).grid(row=3, column=1)
+        tk.Button(window, text="Save", command=self._save_diagnostics).grid(row=3, column=2)
+        tk.Button(window, text="Close", command=window.destroy).grid(row=4, column=0, columnspan=3)
+
+        self._load_diagnostics()
+
+    def _load_diagnostics(self):
+        snapshot = metrics.snapshot()
+        self.diagnostics_tree.delete(*self.diagnostics_tree.get_children())
+        for operation in snapshot["operations"]:
+            self.diagnostics_tree.insert('', tk.END, values=(
+                operation["operation"], operation["calls"], f"{operation['avg_ms']:.1f}", f"{operation['max_ms']:.1f}",
+                f"{operation['total_ms']:.1f}", f"{operation['queries_per_call']:.1f}", f"{operation['sql_ms']:.1f}"))
+        self.diagnostics_label.config(text=f"{snapshot['totals']['queries']} queries, "
+                                           f"{snapshot['totals']['sql_ms']:.1f} ms in SQL")
+
+    def _reset_diagnostics(self):
+        metrics.reset()
+        self._load_diagnostics()
+
+    def _save_diagnostics(self):
+        try:
+            metrics.dump(self.metrics_file)
+        except OSError as e:
+            messagebox.showerror("Diagnostics", f"Cannot write {self.metrics_file}: {e}")
+            return
+        messagebox.showinfo("Diagnostics", f"Metrics saved to {self.metrics_file}")
 
-        tk.Label(self.vote_records_window, text="Vote Records", font=("Helvetica", 16)).grid(row=0, column=0,
-                                                                                             columnspan=2)
-
-        votes = session.query(Vote).all()
-
-        row = 1
-        for vote in votes:
-            voter_initial = vote.voter.account[0] + '*' * (len(vote.voter.account) - 1)
-            candidate_initial = vote.candidate.name[0] + '*' * (len(vote.candidate.name) - 1)
-            tk.Label(self.vote_records_window, text=f"{voter_initial} voted for {candidate_initial}").grid(row=row,
-                                                                                                           column=0,
-                                                                                                           columnspan=2)
-            row += 1
-
-        tk.Button(self.vote_records_window, text="Close", command=self.vote_records_window.destroy).grid(row=row,
-                                                                                                         column=0,
-                                                                                                         columnspan=2)
-
+    @metrics.timed('screen')
     def update_user_profile(self):
         self.clear_screen()
         tk.Label(self.root, text="Update User Profile", font=("Helvetica", 16)).grid(row=0, column=0, columnspan=2)
@@ -326,70 +540,55 @@ class ElectionSystem:
         self.new_age_entry = tk.Entry(self.root)
         self.new_age_entry.grid(row=3, column=1)
 
-        tk.Button(self.root, text="Update Profile", command=self.perform_update).grid(row=4, column=0, columnspan=2)
+        self.update_button = tk.Button(self.root, text="Update Profile", command=self.perform_update)
+        self.update_button.grid(row=4, column=0, columnspan=2)
 
+    @metrics.timed('action')
     def perform_update(self):
         user_account = self.user_account_entry.get()
         new_password = self.new_password_entry.get()
         new_age_str = self.new_age_entry.get()
 
-        # Check if the user exists
-        user = session.query(Voter).filter_by(account=user_account).first()
-        if user:
-            # Update the user's password
-            if new_password:
-                user.password = new_password
-
-            # Update the user's age
-            if new_age_str:
-                new_age = int(new_age_str)
-                if new_age >= 18:
-                    user.age = new_age
-                else:
-                    messagebox.showerror("Update Error", "Age must be 18 or older.")
-                    return
-
-            # Commit the changes to the database
-            session.commit()
-            messagebox.showinfo("Update Success", "User profile updated successfully.")
-            self.create_admin_dashboard_screen()  # Return to the administrator screen
-        else:
-            messagebox.showerror("Update Error", "User not found.")
+        # Update the user's password and/or age; empty fields are left unchanged. A new password is hashed, so
+        # this runs off the Tk thread.
+        self.update_button.config(state=tk.DISABLED)
+        self._run_in_background(self.service.update_voter, (user_account, new_password or None, new_age_str or None),
+                                self._finish_update)
+
+    @metrics.timed('action')
+    def _finish_update(self, future):
+        if self.update_button.winfo_exists():
+            self.update_button.config(state=tk.NORMAL)
+        try:
+            future.result()
+        except Exception as e:
+            messagebox.showerror("Update Error", self._error_text(e))
+            return
+        messagebox.showinfo("Update Success", "User profile updated successfully.")
+        self.create_admin_dashboard_screen()  # Return to the administrator screen
 
 
+    @metrics.timed('screen')
     def show_current_results_bar_chart(self):
-        votes = session.query(Vote.candidate_id, func.count(Vote.candidate_id)).group_by(Vote.candidate_id).all()
-        candidates = [session.query(Candidate).filter_by(id=candidate_id).first() for candidate_id, _ in votes]
-        vote_counts = [count for _, count in votes]
-
-        fig, ax = plt.subplots(figsize=(3, 3))
-        ax.bar([candidate.name for candidate in candidates], vote_counts)
-        ax.set_ylabel('Votes')
-        ax.set_xlabel('Candidates')
-        ax.set_title('Election Results')
+        results = self._dashboard["results"]
+        candidates = [result['name'] for result in results]
+        vote_counts = [result['votes'] for result in results]
 
-        # Convert Matplotlib graphs to a Tkinter compatible format
-        canvas = FigureCanvasTkAgg(fig, master=self.root)
-        canvas.draw()
-        canvas.get_tk_widget().grid(row=6, column=0, columnspan=2, padx=10, pady=10)
+        self.charts.bar('dashboard_results', candidates, vote_counts, figsize=(3, 3), title='Election Results',
+                        xlabel='Candidates', ylabel='Votes').grid(row=6, column=0, columnspan=2, padx=10, pady=10)
 
+    @metrics.timed('screen')
     def show_site_distribution_bar_and_vote_pie_chart(self):
-        sites = session.query(Voter.site, func.count(Voter.id)).group_by(Voter.site).all()
-
-        fig, ax = plt.subplots(figsize=(3, 3))
-        ax.bar([f"site {site}" for site, _ in sites], [count for _, count in sites])
-        ax.set_ylabel('Number of voters')
-        ax.set_xlabel('Site')
-        ax.set_title('Site distribution')
+        sites = self._dashboard["sites"]
+        turnout = self._dashboard["turnout"]
+        total_registered, total_voted = turnout["registered"], turnout["voted"]
 
-        # Convert Matplotlib figure to Tkinter compatible format
-        canvas = FigureCanvasTkAgg(fig, master=self.root)
-        canvas.draw()
-        canvas.get_tk_widget().grid(row=12, column=0, columnspan=2, padx=10, pady=10)  # Adjusted grid parameters
+        self.charts.bar('site_distribution', [f"site {site['site']}" for site in sites],
+                        [site['registered'] for site in sites], figsize=(3, 3), title='Site distribution',
+                        xlabel='Site', ylabel='Number of voters').grid(row=12, column=0, columnspan=2, padx=10,
+                                                                       pady=10)  # Adjusted grid parameters
 
         # Plot the pie chart for the vote percentage
-        total_registered = session.query(func.count(Voter.id)).scalar()
-        total_voted = session.query(func.count(Voter.id)).filter_by(has_voted=True).scalar()
         total_not_voted = total_registered - total_voted
         labels = ['Voted', 'Not Voted']
         sizes = [total_voted, total_not_voted]
@@ -404,34 +603,218 @@ class ElectionSystem:
             # If all sizes are zero, set all sizes to equal values
             sizes = [1] * len(sizes)
 
-        fig2, ax2 = plt.subplots(figsize=(3, 3))
-        ax2.pie(sizes, labels=labels, autopct='%1.1f%%')
-        ax2.axis('equal')  # Ensure the pie chart is circular
-
-        # Convert Matplotlib figure to Tkinter compatible format
-        canvas2 = FigureCanvasTkAgg(fig2, master=self.root)
-        canvas2.draw()
-        canvas2.get_tk_widget().grid(row=12, column=8, columnspan=2, padx=10, pady=10)  # Adjusted grid parameters
+        self.charts.pie('dashboard_turnout', labels, sizes, figsize=(3, 3)).grid(
+            row=12, column=8, columnspan=2, padx=10, pady=10)  # Adjusted grid parameters
 
+    @metrics.timed('screen')
     def show_current_results(self):
-        tk.Label(self.root, text="Current Results", font=("Helvetica", 12)).grid(row=1, column=0, columnspan=2)
+        # Also called by the live refresh, so the previous labels are replaced rather than drawn over
+        for label in self._result_labels:
+            label.destroy()
+        header = tk.Label(self.root, text="Current Results", font=("Helvetica", 12))
+        header.grid(row=1, column=0, columnspan=2)
+        self._result_labels = [header]
 
-        votes = session.query(Vote.candidate_id, func.count(Vote.candidate_id)).group_by(Vote.candidate_id).all()
-        candidates = [session.query(Candidate).filter_by(id=candidate_id).first() for candidate_id, _ in votes]
-        vote_counts = [count for _, count in votes]
+        results = self._dashboard["results"]
+        candidates = [result['name'] for result in results]
+        vote_counts = [result['votes'] for result in results]
 
         for i, candidate in enumerate(candidates):
-            tk.Label(self.root, text=f"{candidate.name}: {vote_counts[i]} votes").grid(row=i + 2, column=0, sticky=tk.W)
+            label = tk.Label(self.root, text=f"{candidate}: {vote_counts[i]} votes")
+            label.grid(row=i + 2, column=0, sticky=tk.W)
+            self._result_labels.append(label)
 
 
 
     def clear_screen(self):
+        self._cancel_dashboard_refresh()
+        self._result_labels = []
+        # Charts are only taken off the screen; the chart manager reuses their figures on the next screen
+        self.charts.detach_all()
         for widget in self.root.winfo_children():
-            widget.destroy()
+            if not self.charts.owns(widget):
+                widget.destroy()
+
+    def close(self):
+        self._cancel_dashboard_refresh()
+        self._background.shutdown(wait=False)
+        self.charts.close_all()
+        self.root.destroy()
 
 if __name__ == '__main__':
-    root = tk.Tk()
-    app = ElectionSystem(root)
-    root.mainloop()
+    parser = argparse.ArgumentParser(description="Election System")
+    parser.add_argument('--db-url', help="SQLAlchemy database URL (default: $ELECTION_DB_URL or sqlite:///election.db)")
+    parser.add_argument('--pool-size', type=int, help="Connections kept open in the pool")
+    parser.add_argument('--max-overflow', type=int, help="Extra connections allowed above the pool size")
+    parser.add_argument('--sqlite-journal-mode', help="SQLite journal_mode pragma, e.g. WAL or DELETE")
+    parser.add_argument('--sqlite-synchronous', help="SQLite synchronous pragma, e.g. NORMAL or FULL")
+    parser.add_argument('--sqlite-mmap-size', type=int, help="SQLite mmap_size pragma in bytes")
+    parser.add_argument('--sqlite-cache-size', type=int, help="SQLite cache_size pragma (negative values are KiB)")
+    parser.add_argument('--api-url', help="Run the Tk app as a client of an election API server at this URL")
+    parser.add_argument('--refresh-ms', type=int, default=2000, help="Admin dashboard live refresh interval")
+    parser.add_argument('--live-dashboard', action='store_true', help="Start the admin dashboard in live mode")
+    parser.add_argument('--shard-dir', help="Store ballots in one SQLite file per polling site in this directory")
+    parser.add_argument('--metrics-file', help="Write the operation metrics to this JSON file on exit (the Diagnostics "
+                                               "panel saves there too; default election_metrics.json)")
+    parser.add_argument('--slow-ms', type=float, default=250, help="Log operations slower than this (0 turns it off)")
+    parser.add_argument('--slow-log', help="Slow-operation log file (default: standard error)")
+    parser.add_argument('--audit-log', help="Append every committed vote to this hash-chained log (one log per site "
+                                            "with --shard-dir)")
+    subparsers = parser.add_subparsers(dest='command')
+    init_parser = subparsers.add_parser('init', help="Create the tables and indexes and seed the database")
+    init_parser.add_argument('--force', action='store_true', help="Run even if the schema is already current")
+    serve_parser = subparsers.add_parser('serve', help="Run the HTTP/JSON election API without a display")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--workers', type=int, default=16, help="Threads for blocking database calls")
+    subparsers.add_parser('rebuild-tallies', help="Recompute the candidate and site tallies from the vote table")
+    subparsers.add_parser('check-plans',
+                          help="Show the query plan of each hot query and flag full table scans and sorted pages")
+    subparsers.add_parser('migrate-passwords', help="Hash any passwords still stored in cleartext")
+    import_parser = subparsers.add_parser('import-voters', help="Bulk import voters from a CSV or JSON-lines file")
+    import_parser.add_argument('path', help="CSV with an account,password,age,site header, or .jsonl/.ndjson")
+    import_parser.add_argument('--chunk-size', type=int, default=10000, help="Rows inserted per transaction")
+    import_parser.add_argument('--hash-passwords', action='store_true',
+                               help="Hash cleartext passwords in each chunk before it is committed, rather than "
+                                    "once the whole roll is in (both cost one PBKDF2 run per row)")
+    subparsers.add_parser('shard-check', help="Add up the shard tallies and look for voters with ballots in two shards")
+    merge_parser = subparsers.add_parser('shard-merge', help="Copy the shard ballots into the main vote table")
+    merge_parser.add_argument('--chunk-size', type=int, default=10000, help="Ballots merged per transaction")
+    export_parser = subparsers.add_parser('export', help="Stream votes, anonymized voters or tallies to a file")
+    export_parser.add_argument('data', choices=list(EXPORTS))
+    export_parser.add_argument('path', help="Output file, or - for standard output")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, help="Default: from the file extension, else csv")
+    export_parser.add_argument('--chunk-size', type=int, default=10000, help="Rows fetched and written at a time")
+    verify_parser = subparsers.add_parser('audit-verify', help="Check the hash chain of audit logs (offline)")
+    verify_parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+    metrics.slow_threshold = args.slow_ms / 1000 if args.slow_ms > 0 else None
+    metrics.slow_log = args.slow_log
+    if args.metrics_file:
+        atexit.register(metrics.dump, args.metrics_file)
+
+    if args.command == 'audit-verify':
+        # Needs nothing but the log files
+        broken = False
+        for path in args.paths:
+            try:
+                entries, last_hash = verify_audit_log(path)
+                print(f"ok        {path}: {entries} entries, last hash {last_hash}")
+            except (OSError, ValueError) as e:
+                print(f"BROKEN    {path}: {e}")
+                broken = True
+        raise SystemExit(1 if broken else 0)
+
+    config = DatabaseConfig.from_env()
+    for name in ('pool_size', 'max_overflow', 'sqlite_journal_mode', 'sqlite_synchronous', 'sqlite_mmap_size',
+                 'sqlite_cache_size'):
+        if getattr(args, name) is not None:
+            setattr(config, name, getattr(args, name))
+    if args.db_url:
+        config.url = args.db_url
+    if args.api_url and args.command is None:
+        # The database belongs to the API server; this terminal only draws screens
+        root = tk.Tk()
+        app = ElectionSystem(root, ElectionApiClient(args.api_url), args.refresh_ms, args.live_dashboard,
+                             args.metrics_file or 'election_metrics.json')
+        root.mainloop()
+        raise SystemExit
+
+    configure_database(config)
+    if args.command == 'init':
+        try:
+            initialized = init_database(args.force)
+        except ServiceError as e:
+            # e.g. a database from an older version holding several votes for one voter
+            parser.exit(1, f"Cannot initialize the database: {e}\n")
+        if initialized:
+            print(f"Database initialized at schema version {SCHEMA_VERSION}.")
+        else:
+            print(f"Database schema is already at version {SCHEMA_VERSION}.")
+        raise SystemExit
+    if schema_version() < SCHEMA_VERSION:
+        # Creating and seeding the schema is kept off the startup path of kiosk terminals
+        parser.exit(1, f"The database schema is at version {schema_version()}, expected {SCHEMA_VERSION}. "
+                       f"Run '{parser.prog} init' first.\n")
+    shards = ShardedVoteStore(args.shard_dir, audit_log=args.audit_log) if args.shard_dir else None
+    if args.command in ('shard-check', 'shard-merge') and shards is None:
+        parser.error(f"{args.command} needs --shard-dir")
+
+    def create_service():
+        if args.audit_log and shards is None:
+            return ElectionService(VoteIngestor(audit_log=AuditLog(args.audit_log)).start())
+        return ElectionService(shards=shards)
+
+    if args.command == 'serve':
+        run_api_server(args.host, args.port, args.workers, create_service())
+    elif args.command == 'rebuild-tallies':
+        with session_scope() as session:
+            rebuild_tallies(session)
+        print("Tallies rebuilt.")
+    elif args.command == 'check-plans':
+        reports = check_query_plans()
+        for name, plan, problems in reports:
+            label = 'FULL SCAN' if any(line.startswith('SCAN') for line in problems) else 'SORT' if problems else 'ok'
+            print(f"{label:<10}{name}")
+            for line in plan:
+                print(f"{'':<10}  {line}")
+        if any(problems for _, _, problems in reports):
+            raise SystemExit(1)
+    elif args.command == 'migrate-passwords':
+        print(f"Hashed {migrate_passwords(progress=lambda migrated: print(f'{migrated} passwords hashed'))} passwords.")
+    elif args.command == 'import-voters':
+        if args.hash_passwords:
+            print("Hashing cleartext passwords costs one PBKDF2 run per row; expect tens of rows per second per core.",
+                  file=sys.stderr)
+        try:
+            read, inserted, skipped, elapsed = import_voters(
+                args.path, args.chunk_size, args.hash_passwords,
+                progress=lambda read, inserted, elapsed: print(
+                    f"{read} rows read, {inserted} inserted ({read / max(elapsed, 1e-9):.0f} rows/sec)"),
+                on_invalid=lambda line, message: print(f"{args.path}:{line}: skipped, {message}", file=sys.stderr))
+        except (OSError, ServiceError) as e:
+            parser.exit(1, f"{e}\n")
+        print(f"Imported {inserted} of {read} voters in {elapsed:.1f}s ({read / max(elapsed, 1e-9):.0f} rows/sec)")
+        if skipped:
+            print(f"{skipped} malformed rows were skipped.")
+        if not args.hash_passwords:
+            # The roll is usable already; no cleartext password is left behind once this finishes. If it is
+            # interrupted, migrate-passwords picks up where it stopped.
+            print("Hashing the imported passwords; expect tens of rows per second per core.", file=sys.stderr)
+            hashed = migrate_passwords(progress=lambda migrated: print(f"{migrated} passwords hashed"))
+            print(f"Hashed {hashed} passwords.")
+    elif args.command == 'shard-check':
+        service = ElectionService(shards=shards)
+        for result in service.results():
+            print(f"{result['votes']:>10}  {result['name']} ({result['party']})")
+        duplicates = shards.find_duplicate_voters()
+        for voter_id in duplicates:
+            print(f"Voter {voter_id} has ballots in more than one shard")
+        service.close()
+        if duplicates:
+            raise SystemExit(1)
+    elif args.command == 'shard-merge':
+        merged, conflicts = shards.merge_into_main(args.chunk_size)
+        shards.close()
+        print(f"Merged {merged} ballots into the main database.")
+        if conflicts:
+            print(f"{conflicts} ballots were not merged because their voters do not exist or have already voted in "
+                  f"the main database; they are kept in the conflicting_ballot table of their shard.")
+            raise SystemExit(1)
+    elif args.command == 'export':
+        try:
+            rows, elapsed = export_data(args.data, args.path, args.format, args.chunk_size)
+        except ServiceError as e:
+            parser.exit(1, f"{e}\n")
+        print(f"Exported {rows} rows in {elapsed:.1f}s", file=sys.stderr)
+        if shards is not None and args.data in ('votes', 'candidate-tallies'):
+            print("Ballots still in the site shards are not included; run shard-merge first.", file=sys.stderr)
+    else:
+        root = tk.Tk()
+        service = create_service()
+        app = ElectionSystem(root, service, refresh_interval_ms=args.refresh_ms, live_dashboard=args.live_dashboard,
+                             metrics_file=args.metrics_file or 'election_metrics.json')
+        root.mainloop()
+        service.close()
 
 
@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import election_service
+from election_service import (SITE_MAP, Candidate, DatabaseConfig, ElectionService, ServiceError, configure_database,
+                              get_vote_ingestor, init_database, insert_new_voters, session_scope)
+
+# Synthesizes an electorate in a temporary SQLite file and drives the election workflows through ElectionService
+# with a thread pool, the way many terminals would. For each operation it reports throughput, p50/p99 latency and
+# the peak resident memory of the process while that operation ran.
+#
+#   python bench_election.py --voters 100000 --ballots 20000 --concurrency 32
+#   python bench_election.py --json bench_output.json   # Machine-readable numbers for regression tracking
+
+
+class _MemorySampler:
+    # Peak resident set size while the sampler is running. Linux exposes the current RSS in /proc/self/statm;
+    # elsewhere the process-wide high-water mark from getrusage is the best available, and Windows reports 0.
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            if resource is None:
+                return 0
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == 'darwin' else maxrss * 1024  # Bytes on macOS, KiB elsewhere
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def run_operation(name, function, arguments, concurrency):
+    # Calls function(*args) for every args in `arguments` from `concurrency` threads and summarizes the run
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(args):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            function(*args)
+            failed = False
+        except ServiceError:
+            failed = True
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            errors += failed
+
+    with _MemorySampler() as memory:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, arguments))
+        wall_time = time.perf_counter() - start
+
+    latencies.sort()
+    return {"operation": name, "count": len(latencies), "errors": errors, "concurrency": concurrency,
+            "seconds": wall_time, "throughput": len(latencies) / wall_time if wall_time else 0.0,
+            "p50_ms": _percentile(latencies, 0.50) * 1000, "p99_ms": _percentile(latencies, 0.99) * 1000,
+            "peak_rss_mb": memory.peak / (1024 * 1024)}
+
+
+def synthesize_electorate(voters, candidates, password, rng, own_hash=(), chunk_size=10000):
+    # Candidates plus `voters` voters spread over every site in SITE_MAP, all with the same password. Hashing it
+    # once per voter would dominate the setup, so voters share one pre-hashed value, except the voter numbers in
+    # `own_hash` (the ones the login benchmark uses), which get their own salted hash: the login cache is keyed on
+    # the stored hash, so shared hashes would turn every login after the first into a cache hit.
+    with session_scope() as session:
+        session.add_all(Candidate(name=f"Candidate {i}", party=f"Party {i % 7}") for i in range(candidates))
+    hashed = election_service.hash_password(password)
+    own_hash = set(own_hash)
+    sites = list(SITE_MAP.values())
+    for start in range(0, voters, chunk_size):
+        rows = [{"account": f"bench{i}", "password": password if i in own_hash else hashed,
+                 "age": rng.randint(18, 95), "has_voted": False, "site": str(rng.choice(sites))}
+                for i in range(start, min(start + chunk_size, voters))]
+        with session_scope() as session:
+            insert_new_voters(session, rows)  # Hashes the cleartext ones on the password pool
+
+
+def run_benchmarks(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='election-bench-')
+    election_service.password_hash_iterations = args.password_iterations
+    configure_database(DatabaseConfig(url=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+                                      pool_size=args.concurrency, max_overflow=args.concurrency))
+    try:
+        init_database()
+        start = time.perf_counter()
+        login_voters = rng.sample(range(args.voters), min(args.logins, args.voters))
+        synthesize_electorate(args.voters, args.candidates, 'bench', rng, own_hash=login_voters)
+        print(f"Synthesized {args.voters} voters and {args.candidates} candidates in "
+              f"{time.perf_counter() - start:.1f}s ({workdir})", file=sys.stderr)
+
+        service = ElectionService()
+        with session_scope() as session:
+            voter_ids = [voter_id for (voter_id,) in session.query(election_service.Voter.id).filter(
+                election_service.Voter.account.like('bench%'))]
+            candidate_ids = [candidate_id for (candidate_id,) in session.query(Candidate.id)]
+        sites = list(SITE_MAP.values())
+
+        ballots = rng.sample(voter_ids, min(args.ballots, len(voter_ids)))
+        logins = [(f"bench{i}", 'bench') for i in login_voters]
+        registrations = [(f"new{i}", 'bench', rng.randint(18, 95), rng.choice(sites)) for i in range(args.registrations)]
+        reads = [()] * args.reads
+
+        results = [
+            run_operation('register', service.register, registrations, args.concurrency),
+            # Every voter once with an empty login cache (a full PBKDF2 check each), then again from the cache
+            run_operation('login (cold)', service.login, logins, args.concurrency),
+            run_operation('login (warm)', service.login, logins, args.concurrency),
+            run_operation('vote', service.vote, [(voter_id, rng.choice(candidate_ids)) for voter_id in ballots],
+                          args.concurrency),
+            run_operation('results', service.results, reads, args.concurrency),
+            run_operation('site_distribution', service.site_distribution, reads, args.concurrency),
+            run_operation('turnout', service.turnout, reads, args.concurrency),
+            run_operation('dashboard_snapshot', service.dashboard_snapshot, reads, args.concurrency),
+        ]
+        get_vote_ingestor().stop()
+        return results
+    finally:
+        if args.keep_db:
+            print(f"Database kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(results, out=sys.stdout):
+    print(f"{'operation':<20}{'count':>9}{'errors':>8}{'ops/sec':>11}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}",
+          file=out)
+    for result in results:
+        print(f"{result['operation']:<20}{result['count']:>9}{result['errors']:>8}{result['throughput']:>11.1f}"
+              f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['peak_rss_mb']:>10.1f}", file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the election workflows against a temporary database")
+    parser.add_argument('--voters', type=int, default=20000, help="Synthesized electorate size")
+    parser.add_argument('--candidates', type=int, default=10)
+    parser.add_argument('--ballots', type=int, default=5000, help="Votes cast, each by a different voter")
+    parser.add_argument('--logins', type=int, default=1000, help="Voters logged in, cold and then warm")
+    parser.add_argument('--registrations', type=int, default=1000)
+    parser.add_argument('--reads', type=int, default=2000, help="Calls of each results/turnout query")
+    parser.add_argument('--concurrency', type=int, default=16, help="Threads driving each operation")
+    parser.add_argument('--password-iterations', type=int, default=election_service.password_hash_iterations,
+                        help="PBKDF2 work factor used for this run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    parser.add_argument('--keep-db', action='store_true', help="Keep the temporary database for inspection")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=2)
@@ -0,0 +1,134 @@
+import threading
+
+import numpy as np
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, object_session
+
+import election_service
+from election_service import Candidate, Vote, Voter, session_scope
+
+# Turnout and candidate share broken down by site, age band and site x age band. The voter ages, sites and votes
+# are read in one streamed query into NumPy arrays and every breakdown is a bincount over combined group codes, so
+# the cost is one pass over the voter table no matter how many sites, bands and candidates there are. Results are
+# cached until a vote or a voter is added, or a voter is edited.
+
+# Lower bounds of the age bands after the first; ages below the first bound fall into the first band
+AGE_BAND_EDGES = (25, 35, 45, 55, 65)
+AGE_BAND_LABELS = ("<25", "25-34", "35-44", "45-54", "55-64", "65+")
+UNKNOWN_AGE = "Unknown"
+# Votes whose candidate is not in the candidate table (see rebuild_tallies()) are counted under this entry
+UNKNOWN_CANDIDATE = {"id": None, "name": "Unknown candidate", "party": ""}
+
+
+def _load_columns(chunk_size=50000):
+    # (ages, sites, candidate ids) with one entry per voter: age -1 when unknown, candidate id 0 when not voted
+    query = select(func.coalesce(Voter.age, -1), func.coalesce(Voter.site, ''),
+                   func.coalesce(Vote.candidate_id, 0)).join(Vote, Vote.voter_id == Voter.id, isouter=True)
+    ages, sites, candidate_ids = [], [], []
+    with election_service.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(query)
+        for rows in result.partitions(chunk_size):
+            chunk_ages, chunk_sites, chunk_candidates = zip(*rows)
+            ages.append(np.array(chunk_ages, dtype=np.int64))
+            sites.append(np.array(chunk_sites, dtype=str))
+            candidate_ids.append(np.array(chunk_candidates, dtype=np.int64))
+    if not ages:
+        return np.zeros(0, np.int64), np.zeros(0, str), np.zeros(0, np.int64)
+    return np.concatenate(ages), np.concatenate(sites), np.concatenate(candidate_ids)
+
+
+def _breakdown(labels, codes, voted, candidate_index, candidate_count):
+    # Registered, voted and votes per candidate for every group in `labels`, `codes` giving each voter's group
+    groups = len(labels)
+    registered = np.bincount(codes, minlength=groups)
+    voted_counts = np.bincount(codes[voted], minlength=groups)
+    votes = np.bincount(codes[voted] * candidate_count + candidate_index, minlength=groups * candidate_count)
+    votes = votes.reshape(groups, candidate_count)
+    return [{"group": label, "registered": int(registered[i]), "voted": int(voted_counts[i]),
+             "votes": votes[i].tolist()} for i, label in enumerate(labels)]
+
+
+def compute_analytics(ages, sites, candidate_ids, candidates):
+    # candidates: CandidateInfo-like tuples, in the order used for the "votes" lists
+    candidate_order = np.array([candidate.id for candidate in candidates], dtype=np.int64)
+    sorter = np.argsort(candidate_order)
+    voted = candidate_ids > 0
+    voted_ids = candidate_ids[voted]
+    known = np.isin(voted_ids, candidate_order)
+    candidate_list = [{"id": candidate.id, "name": candidate.name, "party": candidate.party}
+                      for candidate in candidates]
+    candidate_index = np.full(len(voted_ids), len(candidate_list), dtype=np.int64)
+    candidate_index[known] = sorter[np.searchsorted(candidate_order, voted_ids[known], sorter=sorter)]
+    if not known.all():
+        candidate_list.append(dict(UNKNOWN_CANDIDATE))
+
+    site_labels, site_codes = np.unique(sites, return_inverse=True)
+    site_labels = [label or None for label in site_labels.tolist()]  # '' stands for voters without a site
+
+    band_labels = list(AGE_BAND_LABELS)
+    band_codes = np.searchsorted(AGE_BAND_EDGES, ages, side='right')
+    if (ages < 0).any():
+        band_codes = np.where(ages < 0, len(band_labels), band_codes)
+        band_labels.append(UNKNOWN_AGE)
+
+    cross_codes = site_codes * len(band_labels) + band_codes
+    shape = (len(site_labels), len(band_labels))
+    return {
+        "candidates": candidate_list,
+        "sites": site_labels,
+        "age_bands": band_labels,
+        "by_site": _breakdown(site_labels, site_codes, voted, candidate_index, len(candidate_list)),
+        "by_age_band": _breakdown(band_labels, band_codes, voted, candidate_index, len(candidate_list)),
+        # Rows are sites, columns age bands
+        "site_by_age_band": {
+            "registered": np.bincount(cross_codes, minlength=shape[0] * shape[1]).reshape(shape).tolist(),
+            "voted": np.bincount(cross_codes[voted], minlength=shape[0] * shape[1]).reshape(shape).tolist(),
+        },
+    }
+
+
+class VoterAnalytics:
+    # Keeps the last result until the newest vote or voter id (or the database) changes, or a voter is edited in
+    # this process (ages move voters between bands without adding a row)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._result = None
+
+    def invalidate(self):
+        with self._lock:
+            self._key = None
+
+    def get(self):
+        with session_scope() as session:
+            key = (session.get_bind(),
+                   session.query(func.coalesce(func.max(Vote.id), 0)).scalar(),
+                   session.query(func.coalesce(func.max(Voter.id), 0)).scalar())
+            candidates = session.query(Candidate.id, Candidate.name, Candidate.party).order_by(Candidate.id).all()
+        with self._lock:
+            if key != self._key:
+                self._result = dict(compute_analytics(*_load_columns(), candidates), last_vote_id=key[1],
+                                    last_voter_id=key[2])
+                self._key = key
+            return self._result
+
+
+voter_analytics = VoterAnalytics()
+
+
+# An edited voter (e.g. a new age from update_voter) drops the cache once its transaction has committed, so the next
+# result cannot be computed from the old row
+@event.listens_for(Voter, 'after_update')
+def _note_voter_update(mapper, connection, target):
+    object_session(target).info['voters_updated'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_voter_analytics(session):
+    if session.info.pop('voters_updated', False):
+        voter_analytics.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_voter_update(session):
+    session.info.pop('voters_updated', None)
@@ -0,0 +1,326 @@
+import asyncio
+import http.client
+import json
+import secrets
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from election_metrics import metrics
+from election_service import (ElectionService, ServiceError, ValidationError, AuthenticationError, NotFoundError,
+                              DuplicateVoteError)
+
+# Error classes travel over the wire by name so the client can raise the same exception the service did
+_ERROR_STATUS = {
+    ValidationError: HTTPStatus.BAD_REQUEST,
+    AuthenticationError: HTTPStatus.UNAUTHORIZED,
+    NotFoundError: HTTPStatus.NOT_FOUND,
+    DuplicateVoteError: HTTPStatus.CONFLICT,
+    ServiceError: HTTPStatus.BAD_REQUEST,
+}
+_ERROR_CLASSES = {cls.__name__: cls for cls in _ERROR_STATUS}
+
+MAX_BODY_SIZE = 64 * 1024
+TOKEN_TTL = 30 * 60  # Seconds a login token stays valid after its last use
+MAX_TOKENS = 10000  # Tokens kept at most; the least recently used one is dropped beyond that
+
+
+class ElectionApiServer:
+    # Local HTTP/JSON front end for ElectionService on top of asyncio. Database work runs in a thread pool and
+    # votes are awaited on the ingestor's futures, so a slow batch never blocks other connections.
+    #
+    #   POST /login      {account, password}           -> {token, user}
+    #   POST /logout     (any token)                    -> {}
+    #   POST /register   {account, password, age, site} -> voter
+    #   POST /vote       {candidate_id}   (voter token) -> {vote_id}
+    #   POST /voters/update {account, password, age} (admin token) -> voter
+    #   GET  /candidates, /results, /sites, /turnout, /dashboard
+    #   GET  /analytics (admin token) -> turnout and candidate share by site and age band
+    #   POST /dashboard/changes {since_vote_id, since_voter_id}
+    #   POST /vote-records {after_id, before_id, limit, site, candidate_id} (admin token) -> one page
+    def __init__(self, service=None, host='127.0.0.1', port=8080, workers=16, token_ttl=TOKEN_TTL,
+                 max_tokens=MAX_TOKENS):
+        self.service = service or ElectionService()
+        self.host = host
+        self.port = port
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='election-api')
+        self.token_ttl = token_ttl
+        self.max_tokens = max_tokens
+        # token -> (user dict returned by login, expiry time), least recently used first. Only touched on the event
+        # loop thread.
+        self._tokens = OrderedDict()
+        self._server = None
+        self._routes = {
+            ('POST', '/login'): self._login,
+            ('POST', '/logout'): self._logout,
+            ('POST', '/register'): self._register,
+            ('POST', '/vote'): self._vote,
+            ('POST', '/voters/update'): self._update_voter,
+            ('GET', '/candidates'): self._blocking(self.service.candidates),
+            ('GET', '/results'): self._blocking(self.service.results),
+            ('GET', '/sites'): self._blocking(self.service.site_distribution),
+            ('GET', '/turnout'): self._blocking(self.service.turnout),
+            ('GET', '/dashboard'): self._blocking(self.service.dashboard_snapshot),
+            ('GET', '/analytics'): self._analytics,
+            ('POST', '/dashboard/changes'): self._dashboard_changes,
+            ('POST', '/vote-records'): self._vote_records,
+        }
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]  # Resolves port 0 to the one actually bound
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self._executor.shutdown(wait=False)
+
+    def _run_blocking(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, metrics.call, f"api:{function.__name__}",
+                                                          function, *args)
+
+    def _blocking(self, function):
+        async def handler(body, token):
+            return await self._run_blocking(function)
+        return handler
+
+    def _user(self, token, role):
+        user, expires = self._tokens.get(token, (None, 0))
+        if user is not None and expires < time.monotonic():
+            del self._tokens[token]
+            raise AuthenticationError("Your session has expired, please log in again.")
+        if user is None or user["role"] != role:
+            raise AuthenticationError(f"You are not logged in as {'an' if role == 'admin' else 'a'} {role}.")
+        self._tokens[token] = (user, time.monotonic() + self.token_ttl)
+        self._tokens.move_to_end(token)
+        return user
+
+    def _add_token(self, user):
+        now = time.monotonic()
+        # Every use moves a token to the end with a fresh expiry, so the expired ones are all at the front
+        while self._tokens and next(iter(self._tokens.values()))[1] < now:
+            self._tokens.popitem(last=False)
+        while len(self._tokens) >= self.max_tokens:
+            self._tokens.popitem(last=False)
+        token = secrets.token_urlsafe(24)
+        self._tokens[token] = (user, now + self.token_ttl)
+        return token
+
+    async def _login(self, body, token):
+        account, password = body.get("account", ""), body.get("password", "")
+        user = await asyncio.wrap_future(self.service.submit_login(account, password))
+        return {"token": self._add_token(user), "user": user}
+
+    async def _logout(self, body, token):
+        self._tokens.pop(token, None)
+        return {}
+
+    async def _register(self, body, token):
+        return await self._run_blocking(self.service.register, body.get("account", ""), body.get("password", ""),
+                                        body.get("age", ""), body.get("site"))
+
+    async def _vote(self, body, token):
+        user = self._user(token, "voter")
+        try:
+            candidate_id = int(body["candidate_id"])
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError("candidate_id must be an integer.")
+        # submit_vote() looks up the candidate (and, with shards, the voter and its shard) before queueing the ballot,
+        # so it runs in the pool; only the wait for the commit happens on the loop
+        future = await self._run_blocking(self.service.submit_vote, user["id"], candidate_id)
+        vote_id = await asyncio.wrap_future(future)
+        user["has_voted"] = True
+        return {"vote_id": vote_id}
+
+    async def _update_voter(self, body, token):
+        self._user(token, "admin")
+        return await self._run_blocking(self.service.update_voter, body.get("account", ""), body.get("password"),
+                                        body.get("age"))
+
+    async def _dashboard_changes(self, body, token):
+        try:
+            since_vote_id, since_voter_id = int(body.get("since_vote_id", 0)), int(body.get("since_voter_id", 0))
+        except (TypeError, ValueError):
+            raise ValidationError("since_vote_id and since_voter_id must be integers.")
+        return await self._run_blocking(self.service.dashboard_changes, since_vote_id, since_voter_id)
+
+    async def _analytics(self, body, token):
+        self._user(token, "admin")
+        return await self._run_blocking(self.service.analytics)
+
+    async def _vote_records(self, body, token):
+        self._user(token, "admin")
+        try:
+            after_id, before_id, candidate_id = [None if body.get(key) is None else int(body[key])
+                                                 for key in ("after_id", "before_id", "candidate_id")]
+            limit = int(body.get("limit", 100))
+        except (TypeError, ValueError):
+            raise ValidationError("after_id, before_id, candidate_id and limit must be integers.")
+        return await self._run_blocking(self.service.vote_records, after_id, before_id, limit, body.get("site"),
+                                        candidate_id)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                        {"error": "ServiceError", "message": "Request body too large"}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                status, payload = await self._dispatch(method, path.split('?', 1)[0], body, headers)
+                await self._respond(writer, status, payload, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body, headers):
+        handler = self._routes.get((method, path))
+        if handler is None:
+            return HTTPStatus.NOT_FOUND, {"error": "NotFoundError", "message": f"No route for {method} {path}"}
+        token = headers.get('authorization', '').removeprefix('Bearer ').strip() or None
+        try:
+            data = json.loads(body) if body else {}
+            if not isinstance(data, dict):
+                raise ValidationError("The request body must be a JSON object.")
+            return HTTPStatus.OK, await handler(data, token)
+        except json.JSONDecodeError:
+            return HTTPStatus.BAD_REQUEST, {"error": "ValidationError", "message": "The request body is not JSON."}
+        except ServiceError as e:
+            error_class = next(cls for cls in type(e).__mro__ if cls in _ERROR_STATUS)
+            return _ERROR_STATUS[error_class], {"error": error_class.__name__, "message": str(e)}
+        except Exception as e:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "ServiceError", "message": f"Internal error: {e}"}
+
+    @staticmethod
+    async def _respond(writer, status, payload, close=False):
+        body = json.dumps(payload).encode('utf-8')
+        head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+def run_api_server(host='127.0.0.1', port=8080, workers=16, service=None):
+    server = ElectionApiServer(service, host, port, workers)
+
+    async def main():
+        await server.start()
+        print(f"Election API listening on http://{server.host}:{server.port}")
+        await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        server.service.close()
+
+
+class ElectionApiClient:
+    # Talks to ElectionApiServer with the same method names and return values as ElectionService, so the Tk app can
+    # use either. login() keeps the returned token for the calls that need one.
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.token = None
+
+    def _request(self, method, path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        if self.token:
+            request.add_header('Authorization', f"Bearer {self.token}")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            try:
+                error = json.loads(e.read())
+            except ValueError:
+                raise ServiceError(f"HTTP {e.code}: {e.reason}")
+            raise _ERROR_CLASSES.get(error.get("error"), ServiceError)(error.get("message", ""))
+        except urllib.error.URLError as e:
+            raise ServiceError(f"Cannot reach the election server at {self.base_url}: {e.reason}")
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            # Timeouts, dropped connections and garbled responses after the connection was made
+            raise ServiceError(f"No valid answer from the election server at {self.base_url}: {e!r}")
+
+    def login(self, account, password):
+        response = self._request('POST', '/login', {"account": account, "password": password})
+        self.token = response["token"]
+        return response["user"]
+
+    def logout(self):
+        if self.token:
+            try:
+                self._request('POST', '/logout')
+            finally:
+                self.token = None
+
+    def register(self, account, password, age, site):
+        return self._request('POST', '/register', {"account": account, "password": password, "age": age,
+                                                   "site": site})
+
+    def vote(self, voter_id, candidate_id):
+        # The server takes the voter from the login token
+        return self._request('POST', '/vote', {"candidate_id": candidate_id})["vote_id"]
+
+    def update_voter(self, account, password=None, age=None):
+        return self._request('POST', '/voters/update', {"account": account, "password": password, "age": age})
+
+    def candidates(self):
+        return self._request('GET', '/candidates')
+
+    def results(self):
+        return self._request('GET', '/results')
+
+    def site_distribution(self):
+        return self._request('GET', '/sites')
+
+    def turnout(self):
+        return self._request('GET', '/turnout')
+
+    def dashboard_snapshot(self):
+        return self._request('GET', '/dashboard')
+
+    def analytics(self):
+        return self._request('GET', '/analytics')
+
+    def dashboard_changes(self, since_vote_id, since_voter_id):
+        return self._request('POST', '/dashboard/changes', {"since_vote_id": since_vote_id,
+                                                           "since_voter_id": since_voter_id})
+
+    def vote_records(self, after_id=None, before_id=None, limit=100, site=None, candidate_id=None):
+        return self._request('POST', '/vote-records', {"after_id": after_id, "before_id": before_id, "limit": limit,
+                                                       "site": site, "candidate_id": candidate_id})
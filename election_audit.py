@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Append-only, hash-chained audit log of committed votes. Every line is a JSON object holding one vote and the
+# hash of the line before it, and its own hash covers both, so editing, removing or reordering any earlier line
+# breaks every hash after it. The log holds no voter ids, only which vote was cast for whom and when.
+#
+#   {"candidate_id": 3, "hash": "9f2c...", "prev": "41d0...", "seq": 12, "time": 1760000000.123456, "vote_id": 17}
+
+GENESIS_HASH = '0' * 64
+
+
+def _entry_hash(entry):
+    # Hash of every field except "hash" itself, in a canonical encoding
+    payload = json.dumps({key: value for key, value in entry.items() if key != "hash"}, sort_keys=True,
+                         separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _last_line(path):
+    # The last complete line of the file, read backwards from the end so opening a large log stays cheap
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b''
+        while position > 0:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            lines = tail.rstrip(b'\n').split(b'\n')
+            if len(lines) > 1 or position == 0:
+                return lines[-1].decode('utf-8') if lines[-1] else None
+    return None
+
+
+class AuditLog:
+    # Appends are thread-safe, so several vote writers (e.g. one per shard) can share a log
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._seq, self._last_hash = 0, GENESIS_HASH
+        if os.path.exists(path):
+            last = _last_line(path)
+            if last:
+                entry = json.loads(last)
+                self._seq, self._last_hash = entry["seq"], entry["hash"]
+
+    def append(self, votes):
+        # votes: (vote_id, candidate_id) pairs that have just been committed
+        if not votes:
+            return
+        with self._lock:
+            seq, last_hash = self._seq, self._last_hash
+            lines = []
+            now = round(time.time(), 6)
+            for vote_id, candidate_id in votes:
+                seq += 1
+                entry = {"seq": seq, "vote_id": vote_id, "candidate_id": candidate_id, "time": now, "prev": last_hash}
+                entry["hash"] = last_hash = _entry_hash(entry)
+                lines.append(json.dumps(entry, sort_keys=True) + '\n')
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            # Only advance the chain once the entries are on disk
+            self._seq, self._last_hash = seq, last_hash
+
+
+def verify_audit_log(path):
+    # One streaming pass over the log. Returns (entries, last hash); raises ValueError at the first broken line.
+    previous_hash, seq = GENESIS_HASH, 0
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                raise ValueError(f"line {line_number}: not valid JSON")
+            if entry.get("seq") != seq + 1:
+                raise ValueError(f"line {line_number}: expected entry {seq + 1}, found {entry.get('seq')}")
+            if entry.get("prev") != previous_hash:
+                raise ValueError(f"line {line_number}: does not follow the previous entry")
+            if entry.get("hash") != _entry_hash(entry):
+                raise ValueError(f"line {line_number}: the entry has been modified")
+            previous_hash, seq = entry["hash"], entry["seq"]
+    return seq, previous_hash
@@ -0,0 +1,115 @@
+import math
+
+from election_metrics import metrics
+
+
+class _Chart:
+    def __init__(self, slot, figure, ax, canvas):
+        self.slot = slot
+        self.figure = figure
+        self.ax = ax
+        self.canvas = canvas
+        self.artists = None
+        self.labels = None
+        self.values = None
+
+
+class ChartManager:
+    # Owns every matplotlib chart the app draws. Each chart lives in a named slot whose figure and Tk canvas are
+    # created once and reused on every later screen: bar heights and pie wedges are updated in place, and nothing is
+    # redrawn at all when the data has not changed. Figures are built with matplotlib.figure.Figure rather than
+    # pyplot, so they are not kept alive by pyplot's global figure list. matplotlib itself is only imported when the
+    # first chart is drawn, which keeps it off the app's startup path.
+    def __init__(self, root):
+        self.root = root
+        self._charts = {}
+
+    def _chart(self, slot, figsize):
+        chart = self._charts.get(slot)
+        if chart is None:
+            with metrics.operation(f"chart:{slot}:create"):
+                from matplotlib.figure import Figure
+                from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+                figure = Figure(figsize=figsize)
+                ax = figure.add_subplot()
+                canvas = FigureCanvasTkAgg(figure, master=self.root)
+            chart = self._charts[slot] = _Chart(slot, figure, ax, canvas)
+        return chart
+
+    def bar(self, slot, labels, values, figsize=None, title=None, xlabel=None, ylabel=None):
+        # Returns the canvas widget; the caller places it with grid() or pack()
+        chart = self._chart(slot, figsize)
+        labels, values = list(labels), list(values)
+        if labels != chart.labels:
+            # Different bars: rebuild the axes contents but keep the figure and canvas
+            chart.ax.clear()
+            chart.artists = chart.ax.bar(labels, values)
+            chart.ax.set_ylabel(ylabel)
+            chart.ax.set_xlabel(xlabel)
+            chart.ax.set_title(title)
+            self._draw(chart, labels, values)
+        elif values != chart.values:
+            for bar, value in zip(chart.artists, values):
+                bar.set_height(value)
+            chart.ax.relim()
+            chart.ax.autoscale_view()
+            self._draw(chart, labels, values)
+        return chart.canvas.get_tk_widget()
+
+    def pie(self, slot, labels, sizes, figsize=None, subplots_adjust=None):
+        chart = self._chart(slot, figsize)
+        labels, sizes = list(labels), list(sizes)
+        if sum(sizes) == 0:
+            sizes = [1] * len(sizes)  # An empty pie cannot be drawn
+        if labels != chart.labels:
+            chart.ax.clear()
+            chart.artists = chart.ax.pie(sizes, labels=labels, autopct='%1.1f%%')
+            chart.ax.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
+            if subplots_adjust:
+                chart.figure.subplots_adjust(**subplots_adjust)
+            self._draw(chart, labels, sizes)
+        elif sizes != chart.values:
+            self._move_wedges(chart, sizes)
+            self._draw(chart, labels, sizes)
+        return chart.canvas.get_tk_widget()
+
+    @staticmethod
+    def _move_wedges(chart, sizes):
+        # Same geometry as Axes.pie with its defaults (start angle 0, labels at 1.1, percentages at 0.6)
+        wedges, texts, autotexts = chart.artists
+        total = sum(sizes)
+        theta1 = 0
+        for wedge, text, autotext, size in zip(wedges, texts, autotexts, sizes):
+            theta2 = theta1 + 360 * size / total
+            wedge.set_theta1(theta1)
+            wedge.set_theta2(theta2)
+            middle = math.radians((theta1 + theta2) / 2)
+            x, y = math.cos(middle), math.sin(middle)
+            text.set_position((1.1 * x, 1.1 * y))
+            text.set_horizontalalignment('left' if x > 0 else 'right')
+            autotext.set_position((0.6 * x, 0.6 * y))
+            autotext.set_text('%1.1f%%' % (100 * size / total))
+            theta1 = theta2
+
+    @staticmethod
+    def _draw(chart, labels, values):
+        chart.labels = labels
+        chart.values = values
+        with metrics.operation(f"chart:{chart.slot}:draw"):
+            chart.canvas.draw()
+
+    def owns(self, widget):
+        return any(chart.canvas.get_tk_widget() is widget for chart in self._charts.values())
+
+    def detach_all(self):
+        # Take every chart off the screen without destroying it, so the next screen can reuse it
+        for chart in self._charts.values():
+            widget = chart.canvas.get_tk_widget()
+            widget.grid_forget()
+            widget.pack_forget()
+
+    def close_all(self):
+        for chart in self._charts.values():
+            chart.canvas.get_tk_widget().destroy()
+            chart.figure.clear()
+        self._charts.clear()
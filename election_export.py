@@ -0,0 +1,137 @@
+import csv
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import String, cast, func, select, union_all
+
+import election_service
+from election_service import Candidate, CandidateTally, ServiceError, SiteTally, Vote, Voter, mask_name
+
+# Streams election data out of the database for reporting. Rows are fetched through a server-side cursor (a plain
+# incremental cursor on SQLite) and written chunk by chunk, so memory use depends on the chunk size, not on the
+# size of the election. Voter accounts are masked the same way as in the vote records viewer.
+# Votes for candidate ids that are missing from the candidate table are kept, named "Candidate <id>" like on the
+# results screens. Exports read the main database only: with sharded storage, ballots still in the site shards
+# appear once `python FE2.py shard-merge` has moved them.
+#
+#   python FE2.py export votes votes.csv
+#   python FE2.py export voters voters.parquet --chunk-size 50000
+
+
+def _candidate_name(candidate_id):
+    return func.coalesce(Candidate.name, 'Candidate ' + cast(candidate_id, String))
+
+
+# name -> (columns as (name, type), query, row -> output row)
+EXPORTS = {
+    "votes": (
+        [("id", "int"), ("voter", "str"), ("site", "str"), ("candidate_id", "int"), ("candidate", "str")],
+        lambda: select(Vote.id, Voter.account, Voter.site, Vote.candidate_id, _candidate_name(Vote.candidate_id))
+        .select_from(Vote).join(Vote.voter).join(Vote.candidate, isouter=True).order_by(Vote.id),
+        lambda row: (row[0], mask_name(row[1]), row[2], row[3], row[4]),
+    ),
+    "voters": (
+        [("id", "int"), ("voter", "str"), ("age", "int"), ("site", "str"), ("has_voted", "bool")],
+        lambda: select(Voter.id, Voter.account, Voter.age, Voter.site, Voter.has_voted).order_by(Voter.id),
+        lambda row: (row[0], mask_name(row[1]), row[2], row[3], bool(row[4])),
+    ),
+    "candidate-tallies": (
+        [("candidate_id", "int"), ("candidate", "str"), ("party", "str"), ("votes", "int")],
+        # Every tally, including those of unknown candidates, plus the candidates that have no tally row yet
+        lambda: union_all(
+            select(CandidateTally.candidate_id, _candidate_name(CandidateTally.candidate_id),
+                   func.coalesce(Candidate.party, ''), CandidateTally.votes).join(
+                Candidate, Candidate.id == CandidateTally.candidate_id, isouter=True),
+            select(Candidate.id, Candidate.name, Candidate.party, 0).where(
+                ~select(CandidateTally.candidate_id).where(CandidateTally.candidate_id == Candidate.id).exists()),
+        ).order_by('candidate_id'),
+        tuple,
+    ),
+    "site-tallies": (
+        [("site", "str"), ("registered", "int"), ("voted", "int")],
+        lambda: select(SiteTally.site, SiteTally.registered, SiteTally.voted).order_by(SiteTally.site),
+        tuple,
+    ),
+}
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+
+
+def export_format(path):
+    # The format implied by a file name, CSV by default (and for '-', standard output)
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if path.endswith('.parquet'):
+        return 'parquet'
+    return 'csv'
+
+
+def _iter_chunks(name, chunk_size):
+    columns, query, convert = EXPORTS[name]
+    with election_service.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(query())
+        for rows in result.partitions(chunk_size):
+            yield [convert(row) for row in rows]
+
+
+@contextmanager
+def _open_text(path):
+    if path == '-':
+        yield sys.stdout
+    else:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            yield f
+
+
+def _write_csv(path, columns, chunks):
+    with _open_text(path) as f:
+        writer = csv.writer(f)
+        writer.writerow([column for column, _ in columns])
+        for rows in chunks:
+            writer.writerows(rows)
+            yield len(rows)
+
+
+def _write_jsonl(path, columns, chunks):
+    names = [column for column, _ in columns]
+    with _open_text(path) as f:
+        for rows in chunks:
+            f.writelines(json.dumps(dict(zip(names, row))) + '\n' for row in rows)
+            yield len(rows)
+
+
+def _write_parquet(path, columns, chunks):
+    # One row group per chunk. pyarrow is only needed for this format.
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ServiceError("Parquet export needs the pyarrow package (pip install pyarrow)")
+    if path == '-':
+        raise ServiceError("Parquet files cannot be written to standard output")
+    types = {"int": pyarrow.int64(), "str": pyarrow.string(), "bool": pyarrow.bool_()}
+    schema = pyarrow.schema([(column, types[kind]) for column, kind in columns])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for rows in chunks:
+            writer.write_table(pyarrow.Table.from_pydict(
+                {column: [row[i] for row in rows] for i, (column, _) in enumerate(columns)}, schema=schema))
+            yield len(rows)
+
+
+_WRITERS = {'csv': _write_csv, 'jsonl': _write_jsonl, 'parquet': _write_parquet}
+
+
+def export_data(name, path, output_format=None, chunk_size=10000):
+    # Writes one of EXPORTS to `path` ('-' for standard output). Returns (rows, seconds).
+    if name not in EXPORTS:
+        raise ServiceError(f"Unknown export {name!r}, expected one of: {', '.join(EXPORTS)}")
+    output_format = output_format or export_format(path)
+    if output_format not in _WRITERS:
+        raise ServiceError(f"Unknown format {output_format!r}, expected one of: {', '.join(EXPORT_FORMATS)}")
+    start = time.perf_counter()
+    rows = 0
+    for written in _WRITERS[output_format](path, EXPORTS[name][0], _iter_chunks(name, max(1, chunk_size))):
+        rows += written
+    return rows, time.perf_counter() - start
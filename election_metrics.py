@@ -0,0 +1,155 @@
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Built-in instrumentation. Every SQL statement run by any engine is counted and timed, and the statements are
+# charged to whatever operations (actions, screen renders, chart draws, background jobs) are running on the same
+# thread, including the ones that contain them. Operations that take longer than slow_threshold are written to the
+# slow-operation log together with their query count, which is how an N+1 query pattern shows up.
+#
+#   with metrics.operation("screen:create_vote_screen"): ...
+#   @metrics.timed("action")                                 # Records as "action:<function name>"
+
+
+class _Stats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+    def as_dict(self, name):
+        return {"operation": name, "calls": self.calls, "total_ms": self.seconds * 1000,
+                "avg_ms": self.seconds * 1000 / self.calls if self.calls else 0.0, "max_ms": self.max_seconds * 1000,
+                "queries": self.queries, "queries_per_call": self.queries / self.calls if self.calls else 0.0,
+                "sql_ms": self.sql_seconds * 1000}
+
+
+class _Frame:
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+class Metrics:
+    def __init__(self, slow_threshold=0.25, slow_log=None):
+        self.slow_threshold = slow_threshold  # Seconds; None turns the slow-operation log off
+        self.slow_log = slow_log  # Path of the slow-operation log, standard error when None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}
+        self._totals = _Stats()  # Every statement, whether or not an operation was running
+        self.started = time.time()
+
+    def _frames(self):
+        frames = getattr(self._local, 'frames', None)
+        if frames is None:
+            frames = self._local.frames = []
+        return frames
+
+    def record_query(self, seconds):
+        for frame in self._frames():
+            frame.queries += 1
+            frame.sql_seconds += seconds
+        with self._lock:
+            self._totals.queries += 1
+            self._totals.sql_seconds += seconds
+
+    @contextmanager
+    def operation(self, name):
+        frames = self._frames()
+        frame = _Frame(name)
+        frames.append(frame)
+        start = time.perf_counter()
+        try:
+            yield frame
+        finally:
+            elapsed = time.perf_counter() - start
+            frames.remove(frame)
+            with self._lock:
+                stats = self._stats.get(name)
+                if stats is None:
+                    stats = self._stats[name] = _Stats()
+                stats.calls += 1
+                stats.seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+                stats.queries += frame.queries
+                stats.sql_seconds += frame.sql_seconds
+            if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+                self._log_slow(frame, elapsed)
+
+    def timed(self, kind):
+        # Decorator recording each call of the function as the operation "<kind>:<function name>"
+        def decorator(function):
+            name = f"{kind}:{function.__name__}"
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.operation(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def call(self, name, function, *args):
+        # For work handed to other threads: executor.submit(metrics.call, name, function, *args)
+        with self.operation(name):
+            return function(*args)
+
+    def _log_slow(self, frame, elapsed):
+        line = (f"{time.strftime('%Y-%m-%d %H:%M:%S')} SLOW {frame.name} {elapsed * 1000:.1f}ms "
+                f"queries={frame.queries} sql={frame.sql_seconds * 1000:.1f}ms\n")
+        try:
+            if self.slow_log is None:
+                sys.stderr.write(line)
+            else:
+                with self._lock, open(self.slow_log, 'a', encoding='utf-8') as f:
+                    f.write(line)
+        except OSError:
+            pass  # Instrumentation must never break the operation it measures
+
+    def snapshot(self):
+        # Operations sorted by total time, with the overall statement count and SQL time
+        with self._lock:
+            operations = [stats.as_dict(name) for name, stats in self._stats.items()]
+            totals = {"queries": self._totals.queries, "sql_ms": self._totals.sql_seconds * 1000}
+        operations.sort(key=lambda operation: operation["total_ms"], reverse=True)
+        return {"since": self.started, "taken": time.time(), "totals": totals, "operations": operations}
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._totals = _Stats()
+            self.started = time.time()
+
+
+metrics = Metrics()
+
+
+# Engine-wide hooks, so engines created later (configure_database(), shards) are covered too
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    metrics.record_query(time.perf_counter() - connection.info['query_start'].pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # after_cursor_execute does not run for failed statements
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
@@ -0,0 +1,1115 @@
+import csv
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+from itertools import islice
+from sqlalchemy import (create_engine, Column, Integer, String, Boolean, ForeignKey, Index, func, event, insert,
+                        update, select, literal, union_all, text, inspect, cast, bindparam)
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+
+# Database setup
+@dataclass
+class DatabaseConfig:
+    url: str = 'sqlite:///election.db'
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30.0
+    # SQLite only: applied to every new connection
+    sqlite_journal_mode: str = 'WAL'
+    sqlite_synchronous: str = 'NORMAL'
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_cache_size: int = -64 * 1024  # Negative values are KiB
+    sqlite_busy_timeout: float = 30.0
+
+    @classmethod
+    def from_env(cls):
+        # ELECTION_DB_URL, ELECTION_DB_POOL_SIZE, ELECTION_DB_SQLITE_SYNCHRONOUS, ...
+        config = cls()
+        for field in fields(cls):
+            variable = f"ELECTION_DB_{field.name.upper()}" if field.name != 'url' else 'ELECTION_DB_URL'
+            value = os.environ.get(variable)
+            if value is not None:
+                try:
+                    setattr(config, field.name, field.type(value))
+                except ValueError:
+                    raise ValueError(f"{variable} must be of type {field.type.__name__}, not {value!r}")
+        return config
+
+
+def create_configured_engine(config):
+    url = make_url(config.url)
+    kwargs = {}
+    if url.get_backend_name() == 'sqlite':
+        kwargs['connect_args'] = {'timeout': config.sqlite_busy_timeout}
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # Every connection to an in-memory database is a new, empty database, so all threads (the vote writer, the
+        # password pool, the UI) have to share a single one
+        kwargs['connect_args']['check_same_thread'] = False
+        kwargs['poolclass'] = StaticPool
+    else:
+        kwargs.update(pool_size=config.pool_size, max_overflow=config.max_overflow, pool_timeout=config.pool_timeout)
+    new_engine = create_engine(url, **kwargs)
+
+    if url.get_backend_name() == 'sqlite':
+        @event.listens_for(new_engine, 'connect')
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA journal_mode={config.sqlite_journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={config.sqlite_synchronous}")
+            cursor.execute(f"PRAGMA mmap_size={int(config.sqlite_mmap_size)}")
+            cursor.execute(f"PRAGMA cache_size={int(config.sqlite_cache_size)}")
+            cursor.close()
+    return new_engine
+
+
+def configure_database(config=None):
+    # (Re)binds the module-level engine and session factory; call before any database work
+    global db_config, engine, Session
+    db_config = config or DatabaseConfig.from_env()
+    engine = create_configured_engine(db_config)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+    return engine
+
+
+@contextmanager
+def session_scope():
+    # One session per operation: committed on success, rolled back on error, always closed
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+configure_database()
+Base = declarative_base()
+
+# Define database tables
+class Voter(Base):
+    __tablename__ = 'voter'
+    id = Column(Integer, primary_key=True)
+    account = Column(String, unique=True, nullable=False)
+    password = Column(String, nullable=False)
+    has_voted = Column(Boolean, default=False)
+    site = Column(String, nullable=True)  # Change site column type to String
+    age = Column(Integer, nullable=True)  # Add age column
+    # The rowid is part of every SQLite index, so both cover the turnout and per-site counts
+    __table_args__ = (Index('ix_voter_site', 'site'), Index('ix_voter_has_voted_site', 'has_voted', 'site'))
+
+
+class Vote(Base):
+    __tablename__ = 'vote'
+    id = Column(Integer, primary_key=True)
+    voter_id = Column(Integer, ForeignKey('voter.id'), nullable=False)
+    candidate_id = Column(Integer, ForeignKey('candidate.id'), nullable=False)
+    voter = relationship('Voter')
+    candidate = relationship('Candidate')
+    # One vote per voter is enforced by the database, not only by voter.has_voted
+    __table_args__ = (Index('ux_vote_voter_id', 'voter_id', unique=True), Index('ix_vote_candidate_id', 'candidate_id'))
+
+class Admin(Base):
+    __tablename__ = 'admin'
+    id = Column(Integer, primary_key=True)
+    account = Column(String, unique=True, nullable=False)
+    password = Column(String, nullable=False)
+
+class Candidate(Base):
+    __tablename__ = 'candidate'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    party = Column(String, nullable=False)
+
+# Materialized tallies, kept up to date in the same transaction as the vote/voter rows they count
+class CandidateTally(Base):
+    __tablename__ = 'candidate_tally'
+    candidate_id = Column(Integer, ForeignKey('candidate.id'), primary_key=True)
+    votes = Column(Integer, nullable=False, default=0)
+
+class SiteTally(Base):
+    __tablename__ = 'site_tally'
+    site = Column(String, primary_key=True)  # '' holds voters without a site
+    registered = Column(Integer, nullable=False, default=0)
+    voted = Column(Integer, nullable=False, default=0)
+
+
+# Bump when init_database() has new work to do on databases created by earlier versions
+SCHEMA_VERSION = 1
+
+class SchemaInfo(Base):
+    __tablename__ = 'schema_info'
+    version = Column(Integer, primary_key=True)
+
+
+def _site_key(site):
+    return '' if site is None else str(site)
+
+
+def bump_candidate_tally(session, candidate_id, votes=1):
+    updated = session.query(CandidateTally).filter_by(candidate_id=candidate_id).update(
+        {CandidateTally.votes: CandidateTally.votes + votes}, synchronize_session=False)
+    if not updated:
+        session.add(CandidateTally(candidate_id=candidate_id, votes=votes))
+        session.flush()
+
+
+def bump_site_tally(session, site, registered=0, voted=0):
+    updated = session.query(SiteTally).filter_by(site=_site_key(site)).update(
+        {SiteTally.registered: SiteTally.registered + registered, SiteTally.voted: SiteTally.voted + voted},
+        synchronize_session=False)
+    if not updated:
+        session.add(SiteTally(site=_site_key(site), registered=registered, voted=voted))
+        session.flush()
+
+
+def rebuild_tallies(session):
+    # Recompute both tally tables from the vote and voter tables; the caller commits
+    vote_counts = dict(session.query(Vote.candidate_id, func.count(Vote.id)).group_by(Vote.candidate_id).all())
+    registered = dict(session.query(Voter.site, func.count(Voter.id)).group_by(Voter.site).all())
+    voted = dict(session.query(Voter.site, func.count(Voter.id)).filter_by(has_voted=True).group_by(Voter.site).all())
+
+    session.query(CandidateTally).delete(synchronize_session=False)
+    session.query(SiteTally).delete(synchronize_session=False)
+    for (candidate_id,) in session.query(Candidate.id).all():
+        session.add(CandidateTally(candidate_id=candidate_id, votes=vote_counts.pop(candidate_id, 0)))
+    # Votes pointing at candidates that no longer exist are still counted
+    for candidate_id, count in vote_counts.items():
+        session.add(CandidateTally(candidate_id=candidate_id, votes=count))
+
+    site_rows = {}
+    for site, count in registered.items():
+        key = _site_key(site)
+        site_rows[key] = site_rows.get(key, 0) + count
+    site_voted = {}
+    for site, count in voted.items():
+        key = _site_key(site)
+        site_voted[key] = site_voted.get(key, 0) + count
+    for key, count in site_rows.items():
+        session.add(SiteTally(site=key, registered=count, voted=site_voted.get(key, 0)))
+    session.flush()
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+
+def _normalize_voter_row(data):
+    # Raises ValueError, with a message naming the problem, for rows that cannot be stored
+    if not isinstance(data, dict):
+        raise ValueError("expected an object with account and password fields")
+    for field in ("account", "password"):
+        if data.get(field) in (None, ''):
+            raise ValueError(f"missing {field}")
+    age = data.get("age")
+    site = data.get("site")
+    try:
+        age = int(age) if age not in (None, '') else None
+    except (TypeError, ValueError):
+        raise ValueError(f"age {age!r} is not a whole number")
+    return {"account": str(data["account"]), "password": str(data["password"]),
+            "age": age,
+            "has_voted": _as_bool(data.get("has_voted", False)),
+            "site": str(site) if site not in (None, '') else None}
+
+
+# Passwords are stored as salted PBKDF2-SHA256 hashes: "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>".
+# The work factor can be tuned with ELECTION_PASSWORD_ITERATIONS; existing hashes are upgraded on the next login.
+PASSWORD_HASH_PREFIX = 'pbkdf2_sha256'
+password_hash_iterations = int(os.environ.get('ELECTION_PASSWORD_ITERATIONS', 200000))
+
+# hashlib releases the GIL while hashing, so a thread pool keeps hashing off the UI thread and the API event loop
+_password_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('ELECTION_PASSWORD_WORKERS', os.cpu_count() or 4)),
+                                    thread_name_prefix='password-hash')
+
+
+def hash_password(password, iterations=None):
+    iterations = iterations or password_hash_iterations
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"{PASSWORD_HASH_PREFIX}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def is_password_hash(stored):
+    return stored.startswith(PASSWORD_HASH_PREFIX + '$')
+
+
+def verify_password(password, stored):
+    if not is_password_hash(stored):
+        # A row that has not been migrated yet still holds the cleartext password
+        return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+    _, iterations, salt, digest = stored.split('$')
+    candidate = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(candidate.hex(), digest)
+
+
+def password_needs_rehash(stored):
+    return not is_password_hash(stored) or int(stored.split('$')[1]) != password_hash_iterations
+
+
+def hash_passwords(rows):
+    # Hash the "password" of every row in place on the password pool, leaving values that are already hashed
+    pending = [row for row in rows if not is_password_hash(row["password"])]
+    for row, hashed in zip(pending, _password_pool.map(hash_password, [row["password"] for row in pending])):
+        row["password"] = hashed
+    return rows
+
+
+class AuthCache:
+    # Remembers recently verified logins so a repeated login skips the expensive hash. Entries hold a keyed HMAC of
+    # the password (the key never leaves this process) and are tied to the stored hash, so a password change
+    # invalidates them automatically.
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tag(self, password):
+        return hmac.new(self._key, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def check(self, stored, password):
+        with self._lock:
+            tag = self._entries.get(stored)
+            if tag is not None:
+                self._entries.move_to_end(stored)
+        return tag is not None and hmac.compare_digest(tag, self._tag(password))
+
+    def remember(self, stored, password):
+        with self._lock:
+            self._entries[stored] = self._tag(password)
+            self._entries.move_to_end(stored)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+auth_cache = AuthCache()
+
+
+def find_account(session, account):
+    # Voter or Admin with this account in a single round trip; a voter wins if both exist
+    return session.execute(find_account_statement(account)).mappings().first()
+
+
+def find_account_statement(account):
+    voters = select(literal(0).label('priority'), literal('voter').label('role'), Voter.id, Voter.account,
+                    Voter.password, Voter.has_voted, Voter.site, Voter.age).where(Voter.account == account)
+    admins = select(literal(1), literal('admin'), Admin.id, Admin.account, Admin.password, literal(None),
+                    literal(None), literal(None)).where(Admin.account == account)
+    return union_all(voters, admins).order_by('priority').limit(1)
+
+
+def migrate_passwords(chunk_size=1000, progress=None):
+    # Hash every cleartext password left in the voter and admin tables, committing chunk by chunk (so it can be
+    # interrupted and run again) and calling progress(rows updated so far) after each; returns the number of rows
+    # updated
+    migrated = 0
+    for model in (Voter, Admin):
+        last_id = 0
+        while True:
+            with session_scope() as session:
+                rows = session.query(model.id, model.password).filter(
+                    model.id > last_id, ~model.password.startswith(PASSWORD_HASH_PREFIX + '$')).order_by(
+                    model.id).limit(chunk_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                hashed = hash_passwords([{"id": row.id, "password": row.password} for row in rows])
+                # Only rows still holding the password that was hashed, so a change made meanwhile (e.g. by
+                # update_voter()) is not overwritten with the hash of the old one
+                result = session.connection().execute(
+                    update(model.__table__).where(model.id == bindparam('row_id'),
+                                                  model.password == bindparam('old_password')).values(
+                        password=bindparam('new_password')),
+                    [{"row_id": row.id, "old_password": row.password, "new_password": new["password"]}
+                     for row, new in zip(rows, hashed)])
+                migrated += result.rowcount
+            if progress is not None:
+                progress(migrated)
+    return migrated
+
+
+def insert_new_voters(session, rows, hash_cleartext=True):
+    # Insert the voters whose account is not taken yet with a single executemany; the caller commits.
+    # Returns the number of rows inserted. Passwords that are already PBKDF2 hashes are stored as they are; cleartext
+    # ones are hashed unless hash_cleartext is False, in which case login or migrate_passwords() hashes them later.
+    by_account = {}
+    for row in rows:
+        by_account.setdefault(row["account"], row)  # The first occurrence of an account in a batch wins
+
+    existing = set()
+    for accounts in _chunked(by_account, 500):  # Stay well below SQLite's bound parameter limit
+        existing.update(account for (account,) in session.query(Voter.account).filter(Voter.account.in_(accounts)))
+
+    new_rows = [row for account, row in by_account.items() if account not in existing]
+    if new_rows:
+        new_rows = [dict(row) for row in new_rows]
+        session.execute(insert(Voter), hash_passwords(new_rows) if hash_cleartext else new_rows)
+        registered = Counter(row["site"] for row in new_rows)
+        voted = Counter(row["site"] for row in new_rows if row["has_voted"])
+        for site, count in registered.items():
+            bump_site_tally(session, site, registered=count, voted=voted[site])
+    return len(new_rows)
+
+
+def _iter_voter_file(path):
+    # Stream (line number, record) pairs from a CSV file (with a header row) or a JSON-lines file. Lines that are not
+    # valid JSON are yielded as their ValueError.
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except ValueError:
+                        yield line_number, ValueError("not valid JSON")
+        else:
+            reader = csv.DictReader(f)
+            missing = [field for field in ("account", "password") if field not in (reader.fieldnames or ())]
+            if missing:
+                raise ValidationError(f"{path}: the header row has no {' or '.join(missing)} column")
+            for row in reader:
+                yield reader.line_num, row
+
+
+def import_voters(path, chunk_size=10000, hash_cleartext=False, progress=None, on_invalid=None):
+    # Bulk load an electoral roll, committing one chunk at a time so memory stays bounded. Hashing costs a full
+    # PBKDF2 run per row (tens of rows per second per core), so cleartext passwords are only hashed here on request;
+    # otherwise the caller runs migrate_passwords() once the roll is in (the import-voters command does).
+    # Malformed rows are skipped and passed to on_invalid(line number, message); progress(read, inserted, seconds)
+    # is called after every chunk. Returns (rows read, inserted, skipped, seconds).
+    start = time.perf_counter()
+    read = inserted = skipped = 0
+
+    def valid_rows():
+        nonlocal skipped
+        for line_number, data in _iter_voter_file(path):
+            try:
+                if isinstance(data, ValueError):
+                    raise data
+                yield _normalize_voter_row(data)
+            except ValueError as e:
+                skipped += 1
+                if on_invalid is not None:
+                    on_invalid(line_number, str(e))
+
+    for chunk in _chunked(valid_rows(), chunk_size):
+        with session_scope() as session:
+            inserted += insert_new_voters(session, chunk, hash_cleartext)
+        read += len(chunk)
+        if progress is not None:
+            progress(read + skipped, inserted, time.perf_counter() - start)
+    return read + skipped, inserted, skipped, time.perf_counter() - start
+
+
+# Errors raised by the service layer; the message is meant to be shown to the user as-is
+class ServiceError(Exception):
+    pass
+
+
+class ValidationError(ServiceError):
+    pass
+
+
+class AuthenticationError(ServiceError):
+    pass
+
+
+class NotFoundError(ServiceError):
+    pass
+
+
+class DuplicateVoteError(ServiceError):
+    pass
+
+
+def _claim_voters(session, voter_ids):
+    # Flip has_voted for the given voters and return {voter_id: site} for those that had not voted yet.
+    # The conditional UPDATE is what rejects double votes, even across terminals and batches. "IS NOT 1" rather
+    # than "= 0" keeps SQLite on the primary key instead of the has_voted index.
+    claimed = {}
+    if session.get_bind().dialect.update_returning:
+        for ids in _chunked(voter_ids, 500):
+            claimed.update(session.execute(
+                update(Voter).where(Voter.id.in_(ids), Voter.has_voted.isnot(True)).values(has_voted=True)
+                .returning(Voter.id, Voter.site), execution_options={"synchronize_session": False}).all())
+    else:
+        for voter_id in voter_ids:
+            if session.query(Voter).filter(Voter.id == voter_id, Voter.has_voted.isnot(True)).update(
+                    {Voter.has_voted: True}, synchronize_session=False):
+                claimed[voter_id] = session.query(Voter.site).filter_by(id=voter_id).scalar()
+    return claimed
+
+
+def record_ballots(session, ballots):
+    # Record (voter_id, candidate_id) ballots and their tallies in the session's transaction; the caller commits.
+    # Returns the new vote id for each ballot, or None where the voter does not exist or has already voted.
+    claimed = _claim_voters(session, list(dict.fromkeys(voter_id for voter_id, _ in ballots)))
+    new_votes = []
+    sites = Counter()
+    for voter_id, candidate_id in ballots:
+        # Only the first ballot of a voter that appears twice in the same batch is accepted
+        if voter_id in claimed:
+            sites[claimed.pop(voter_id)] += 1
+            new_votes.append(Vote(voter_id=voter_id, candidate_id=candidate_id))
+        else:
+            new_votes.append(None)
+
+    accepted = [vote for vote in new_votes if vote is not None]
+    if accepted:
+        session.add_all(accepted)
+        session.flush()
+        for candidate_id, count in Counter(vote.candidate_id for vote in accepted).items():
+            bump_candidate_tally(session, candidate_id, votes=count)
+        for site, count in sites.items():
+            bump_site_tally(session, site, voted=count)
+    return [vote.id if vote is not None else None for vote in new_votes]
+
+
+class VoteIngestor:
+    # Queues ballots from any number of terminals and group-commits them from a single writer thread, so a burst of
+    # ballots costs one transaction (and one fsync) per batch rather than per ballot.
+    # submit() returns a Future that resolves to the vote id only once the batch holding the ballot is committed.
+    _STOP = object()
+
+    def __init__(self, session_factory=None, batch_size=200, max_latency=0.05, max_queue=10000, record=None,
+                 audit_log=None):
+        self.session_factory = session_factory  # Defaults to the Session configured when the batch is written
+        self.record = record or record_ballots  # record(session, ballots) -> vote id or None per ballot
+        self.audit_log = audit_log  # election_audit.AuditLog, appended to after every commit
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='vote-ingestor', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        # Flushes everything already queued before the writer exits
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, voter_id, candidate_id, timeout=None):
+        # Blocks for up to `timeout` seconds when the queue is full, then raises queue.Full
+        future = Future()
+        self._queue.put((voter_id, candidate_id, future), timeout=timeout)
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        session = (self.session_factory or Session)()
+        try:
+            vote_ids = self.record(session, [(voter_id, candidate_id) for voter_id, candidate_id, _ in batch])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if len(batch) > 1:
+                # Retry one by one so a single bad ballot does not fail the rest of its batch
+                for item in batch:
+                    self._commit([item])
+            else:
+                batch[0][2].set_exception(e)
+            return
+        finally:
+            session.close()
+
+        if self.audit_log is not None:
+            try:
+                self.audit_log.append([(vote_id, candidate_id) for (_, candidate_id, _), vote_id in zip(batch, vote_ids)
+                                       if vote_id is not None])
+            except OSError as e:
+                error = ServiceError(f"The vote was recorded but the audit log could not be written: {e}")
+                for _, _, future in batch:
+                    future.set_exception(error)
+                return
+
+        for (voter_id, _, future), vote_id in zip(batch, vote_ids):
+            if vote_id is None:
+                future.set_exception(DuplicateVoteError(f"Voter {voter_id} does not exist or has already voted"))
+            else:
+                future.set_result(vote_id)
+
+
+_vote_ingestor = None
+_vote_ingestor_lock = threading.Lock()
+
+
+def get_vote_ingestor():
+    global _vote_ingestor
+    with _vote_ingestor_lock:
+        if _vote_ingestor is None:
+            _vote_ingestor = VoteIngestor().start()
+        return _vote_ingestor
+
+
+CandidateInfo = namedtuple('CandidateInfo', ['id', 'name', 'party'])
+
+
+class CandidateRegistry:
+    # In-process id -> name/party cache, loaded with a single query and dropped whenever a candidate changes
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._candidates = None
+        self._bind = None
+
+    def invalidate(self):
+        with self._lock:
+            self._candidates = None
+
+    def _load(self, session):
+        with self._lock:
+            if self._candidates is None or self._bind is not session.get_bind():
+                # Reloaded when the database is reconfigured, too
+                self._bind = session.get_bind()
+                self._candidates = {candidate_id: CandidateInfo(candidate_id, name, party) for candidate_id, name, party
+                                    in session.query(Candidate.id, Candidate.name, Candidate.party).order_by(Candidate.id)}
+            return self._candidates
+
+    def all(self, session):
+        return list(self._load(session).values())
+
+    def find(self, session, candidate_id):
+        # None for an unknown id
+        candidate = self._load(session).get(candidate_id)
+        if candidate is None:
+            # The candidate may have been added by another process since the registry was loaded
+            self.invalidate()
+            candidate = self._load(session).get(candidate_id)
+        return candidate
+
+    def get(self, session, candidate_id):
+        return self.find(session, candidate_id) or CandidateInfo(candidate_id, f"Candidate {candidate_id}", "")
+
+
+candidate_registry = CandidateRegistry()
+
+
+@event.listens_for(Candidate, 'after_insert')
+@event.listens_for(Candidate, 'after_update')
+@event.listens_for(Candidate, 'after_delete')
+def _invalidate_candidate_registry(mapper, connection, target):
+    candidate_registry.invalidate()
+
+
+def get_candidate_tallies(session):
+    # (candidate_id, votes) for every candidate that has received at least one vote
+    return session.query(CandidateTally.candidate_id, CandidateTally.votes).filter(
+        CandidateTally.votes > 0).order_by(CandidateTally.candidate_id).all()
+
+
+def get_candidate_results(session):
+    # (CandidateInfo, votes) pairs, resolved through the registry instead of one query per candidate
+    return [(candidate_registry.get(session, candidate_id), votes)
+            for candidate_id, votes in get_candidate_tallies(session)]
+
+
+def get_site_tallies(session):
+    # (site, registered) for every site, in the same shape as a GROUP BY over voter.site
+    return [(site or None, count) for site, count in
+            session.query(SiteTally.site, SiteTally.registered).order_by(SiteTally.site).all()]
+
+
+def get_turnout(session):
+    total_registered, total_voted = session.query(func.coalesce(func.sum(SiteTally.registered), 0),
+                                                  func.coalesce(func.sum(SiteTally.voted), 0)).one()
+    return total_registered, total_voted
+
+# Candidates and voters that every fresh database starts with
+candidates_info = [
+    {"name": "Kennedy", "party": "Party A"},
+    {"name": "Biden", "party": "Party B"},
+    {"name": "Trump", "party": "Party C"},
+    {"name": "Putin", "party": "Party D"},
+    {"name": "Macron", "party": "Party E"}
+]
+
+pre_defined_voters_info = [
+    {"account": "a1", "password": "1", "age": 25, "has_voted": False, "site": 1},
+    {"account": "b2", "password": "2", "age": 30, "has_voted": False, "site": 2},
+    {"account": "c3", "password": "3", "age": 22, "has_voted": False, "site": 3},
+    {"account": "d4", "password": "4", "age": 25, "has_voted": False, "site": 5},
+    {"account": "e5", "password": "5", "age": 25, "has_voted": False, "site": 1},
+    {"account": "f6", "password": "6", "age": 34, "has_voted": False, "site": 2},
+    {"account": "g7", "password": "7", "age": 45, "has_voted": False, "site": 4},
+    {"account": "h8", "password": "8", "age": 25, "has_voted": False, "site": 1},
+    {"account": "i9", "password": "9", "age": 36, "has_voted": False, "site": 7},
+    {"account": "j10", "password": "10", "age": 30, "has_voted": False, "site": 8},
+    {"account": "k11", "password": "11", "age": 31, "has_voted": False, "site": 1},
+    {"account": "l12", "password": "12", "age": 27, "has_voted": False, "site": 1},
+    {"account": "m13", "password": "13", "age": 28, "has_voted": False, "site": 3},
+    {"account": "n14", "password": "14", "age": 29, "has_voted": False, "site": 6},
+    {"account": "015", "password": "15", "age": 36, "has_voted": False, "site": 6}
+]
+
+
+def schema_version():
+    # 0 for databases that init_database() has never run on
+    if not inspect(engine).has_table(SchemaInfo.__tablename__):
+        return 0
+    with session_scope() as session:
+        return session.query(func.max(SchemaInfo.version)).scalar() or 0
+
+
+def init_database(force=False):
+    # Create database tables and seed them. This is a separate step from starting the app, and does nothing (returning
+    # False) when the database is already at SCHEMA_VERSION unless forced.
+    if not force and schema_version() >= SCHEMA_VERSION:
+        return False
+    Base.metadata.create_all(engine)
+    ensure_indexes()
+    with session_scope() as session:
+        seed_database(session)
+        session.query(SchemaInfo).delete()
+        session.add(SchemaInfo(version=SCHEMA_VERSION))
+    return True
+
+
+def ensure_indexes():
+    # create_all() skips tables that already exist, so databases created by older versions get their indexes here
+    with session_scope() as session:
+        duplicates = session.query(Vote.voter_id).group_by(Vote.voter_id).having(func.count(Vote.id) > 1).limit(
+            10).all()
+    if duplicates:
+        raise ServiceError("Cannot enforce one vote per voter, these voters have several votes: "
+                           + ", ".join(str(voter_id) for (voter_id,) in duplicates))
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+    refresh_statistics()
+
+
+# Tables that grow with the electorate; scanning the small candidate and tally tables is expected
+_GROWING_TABLES = ('voter', 'vote')
+
+
+def refresh_statistics():
+    # Without statistics SQLite may prefer a new index over a primary key range (e.g. for "vote.id > ?"), so the
+    # small tables are analyzed. The growing tables are kept out of sqlite_stat1 on purpose: statistics gathered
+    # while they were small (a fresh or test database) would stay frozen as they grow and keep the planner scanning
+    # them, while without any SQLite assumes they are large, which is what the hot queries are written for.
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in _GROWING_TABLES:
+                connection.execute(text(f'ANALYZE "{table.name}"'))
+        connection.execute(text("DELETE FROM sqlite_stat1 WHERE tbl IN ("
+                                + ", ".join(f"'{table}'" for table in _GROWING_TABLES) + ")"))
+        # Makes this connection reload the edited statistics; others load them when they open
+        connection.execute(text("ANALYZE sqlite_master"))
+
+
+def vote_records_query(session, site=None, candidate_id=None):
+    # Vote id, voter account, site and candidate name for the vote records viewer, to be ordered by vote id and
+    # limited. The filters are written as expressions ("|| ''", "+ 0") so SQLite cannot use the site or candidate
+    # index for them: driving from an index would read and sort every matching vote for each page, while walking
+    # the vote primary key stops after one page. Votes for candidates missing from the candidate table are kept.
+    candidate_name = func.coalesce(Candidate.name, 'Candidate ' + cast(Vote.candidate_id, String))
+    query = session.query(Vote.id, Voter.account, Voter.site, candidate_name).select_from(Vote).join(Vote.voter).join(
+        Vote.candidate, isouter=True)
+    if site not in (None, ''):
+        query = query.filter(Voter.site.concat('') == str(site))
+    if candidate_id not in (None, ''):
+        query = query.filter(Vote.candidate_id + 0 == int(candidate_id))
+    return query
+
+
+def _hot_queries(session):
+    # The lookups that the screens, the API and the maintenance commands run most, as (name, query) pairs
+    return [
+        ("turnout: voted", session.query(func.count(Voter.id)).filter_by(has_voted=True)),
+        ("turnout: registered", session.query(func.count(Voter.id))),
+        ("site distribution", session.query(Voter.site, func.count(Voter.id)).group_by(Voter.site)),
+        ("site turnout", session.query(Voter.site, func.count(Voter.id)).filter_by(has_voted=True).group_by(
+            Voter.site)),
+        ("votes per candidate", session.query(Vote.candidate_id, func.count(Vote.id)).group_by(Vote.candidate_id)),
+        ("vote by voter", session.query(Vote.id).filter(Vote.voter_id == 1)),
+        ("login lookup", find_account_statement('a1')),
+        ("claim voter", update(Voter).where(Voter.id.in_([1, 2]), Voter.has_voted.isnot(True)).values(
+            has_voted=True)),
+        ("dashboard changes", session.query(Vote.candidate_id, Voter.site, func.count(Vote.id)).join(Vote.voter).filter(
+            Vote.id > 0).group_by(Voter.site, Vote.candidate_id)),
+        ("vote records page", vote_records_query(session).filter(Vote.id > 0).order_by(Vote.id).limit(100)),
+        ("vote records page by site", vote_records_query(session, site='1').filter(Vote.id > 0).order_by(
+            Vote.id).limit(100)),
+        ("vote records page by candidate", vote_records_query(session, candidate_id=1).filter(
+            Vote.id < 1000).order_by(Vote.id.desc()).limit(100)),
+        ("tally read", session.query(CandidateTally.candidate_id, CandidateTally.votes).filter(
+            CandidateTally.votes > 0).order_by(CandidateTally.candidate_id)),
+    ]
+
+
+def _plan_problems(plan, limited):
+    # The plan lines that make a query's cost grow with the electorate: SQLite reading the whole of a growing table,
+    # or a whole index of one that does not cover the query, and, for a LIMITed (paged) query, sorting the rows in
+    # a temporary B-tree, which means every matching row is read and sorted to return one page
+    return [line for line in plan
+            if line.startswith('SCAN') and 'COVERING INDEX' not in line and line.split()[1] in _GROWING_TABLES
+            or limited and line.startswith('USE TEMP B-TREE') and 'ORDER BY' in line]
+
+
+def check_query_plans():
+    # Runs EXPLAIN QUERY PLAN on every hot query and returns (name, plan lines, problem lines) for each; see
+    # _plan_problems(). Statistics are refreshed first, so databases that were analyzed by older versions are
+    # checked with the plans they will get from now on.
+    if engine.dialect.name != 'sqlite':
+        raise ServiceError("Query plan checks are only implemented for SQLite.")
+    refresh_statistics()
+    reports = []
+    with session_scope() as session:
+        for name, query in _hot_queries(session):
+            statement = getattr(query, 'statement', query)
+            sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+            plan = [row[-1] for row in session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+            limited = getattr(statement, '_limit_clause', None) is not None
+            reports.append((name, plan, _plan_problems(plan, limited)))
+    return reports
+
+
+def seed_database(session):
+    # Tallies are rebuilt from scratch the first time this version runs against an existing database
+    tallies_missing = session.query(SiteTally).first() is None and session.query(CandidateTally).first() is None
+
+    # Check if candidates exist in the database, if not, add them
+    existing_candidate_names = [name for (name,) in session.query(Candidate.name)]
+    for data in candidates_info:
+        if data["name"] not in existing_candidate_names:
+            session.add(Candidate(name=data["name"], party=data["party"]))
+
+    # Add preset voter information, skipping accounts that already exist
+    insert_new_voters(session, [_normalize_voter_row(data) for data in pre_defined_voters_info])
+
+    if tallies_missing:
+        rebuild_tallies(session)
+
+
+# Polling sites as shown to users, mapped to the value stored in voter.site
+SITE_MAP = {"Site 1": 1, "Site 2": 2, "Site 3": 3, "Site 4": 4, "Site 5": 5, "Site 6": 6, "Site 7": 7, "Site 8": 8}
+
+# Predefined admin account
+admin_account = "admin"
+admin_password = "admin"
+
+
+def apply_dashboard_changes(snapshot, changes):
+    # Folds the output of ElectionService.dashboard_changes() into a dashboard_snapshot(), returning a new snapshot
+    if "snapshot" in changes:
+        return changes["snapshot"]
+    results = {result["id"]: dict(result) for result in snapshot["results"]}
+    sites = {site["site"]: site["registered"] for site in snapshot["sites"]}
+    total_registered, total_voted = snapshot["turnout"]["registered"], snapshot["turnout"]["voted"]
+    for change in changes["votes"]:
+        result = results.setdefault(change["id"], {"id": change["id"], "name": change["name"],
+                                                   "party": change["party"], "votes": 0})
+        result["votes"] += change["votes"]
+        total_voted += change["votes"]
+    for change in changes["registrations"]:
+        sites[change["site"]] = sites.get(change["site"], 0) + change["registered"]
+        total_registered += change["registered"]
+    return {"results": [results[candidate_id] for candidate_id in sorted(results)],
+            "sites": [{"site": site, "registered": sites[site]} for site in sorted(sites, key=lambda site: site or '')],
+            "turnout": {"registered": total_registered, "voted": total_voted},
+            "last_vote_id": changes["last_vote_id"], "last_voter_id": changes["last_voter_id"]}
+
+
+def mask_name(text):
+    # Keep the first character and star out the rest, as shown in the vote records
+    return text[0] + '*' * (len(text) - 1) if text else text
+
+
+class ElectionService:
+    # UI-independent election operations. Everything takes and returns plain values (ids, strings, dicts), so the
+    # same calls serve the Tk app in-process and the HTTP API in election_api.py. With a ShardedVoteStore
+    # (election_shards.py) ballots go to per-site shard files instead of the main vote table.
+    def __init__(self, ingestor=None, shards=None):
+        self._ingestor = ingestor
+        self.shards = shards
+
+    @property
+    def ingestor(self):
+        return self._ingestor or get_vote_ingestor()
+
+    def close(self):
+        self.ingestor.stop()
+        if self.shards is not None:
+            self.shards.close()
+
+    @staticmethod
+    def _voter_dict(voter):
+        return {"role": "voter", "id": voter.id, "account": voter.account, "has_voted": bool(voter.has_voted),
+                "site": voter.site, "age": voter.age}
+
+    def submit_login(self, account, password):
+        # Returns a Future for login(): the lookup and the password hash run on the password pool
+        return _password_pool.submit(self._login, account, password)
+
+    def login(self, account, password):
+        return self.submit_login(account, password).result()
+
+    def _login(self, account, password):
+        if not isinstance(account, str) or not isinstance(password, str):
+            raise AuthenticationError("Invalid account or password")
+        if account == admin_account and hmac.compare_digest(password.encode('utf-8'), admin_password.encode('utf-8')):
+            # The predefined administrator account
+            return {"role": "admin", "id": None, "account": account}
+        with session_scope() as session:
+            user = find_account(session, account)
+        if not user or not (auth_cache.check(user["password"], password) or verify_password(password,
+                                                                                              user["password"])):
+            raise AuthenticationError("Invalid account or password")
+
+        stored = user["password"]
+        if password_needs_rehash(stored):
+            # Cleartext rows and outdated work factors are upgraded as soon as the password is known
+            stored = hash_password(password)
+            model = Voter if user["role"] == "voter" else Admin
+            with session_scope() as session:
+                # Unless the password was changed since it was read; the new one must not be replaced by this hash
+                upgraded = session.query(model).filter(model.id == user["id"],
+                                                       model.password == user["password"]).update(
+                    {model.password: stored}, synchronize_session=False)
+            if not upgraded:
+                stored = None
+        if stored is not None:
+            auth_cache.remember(stored, password)
+
+        if user["role"] == "voter":
+            has_voted = bool(user["has_voted"])
+            if self.shards is not None and not has_voted:
+                # Unmerged ballots only exist in the voter's site shard
+                has_voted = self.shards.has_voted(user["site"], user["id"])
+            return {"role": "voter", "id": user["id"], "account": user["account"],
+                    "has_voted": has_voted, "site": user["site"], "age": user["age"]}
+        return {"role": "admin", "id": user["id"], "account": user["account"]}
+
+    def register(self, account, password, age, site):
+        # Check that the age matches the format
+        age_str = str(age)
+        if not age_str.isdigit():
+            raise ValidationError("Age must be a valid integer.")
+        age = int(age_str)
+        # Check if the age is under 18
+        if age < 18:
+            raise ValidationError("You must be 18 years or older to register.")
+        if not account or not password:
+            raise ValidationError("Account and password are required.")
+        if not isinstance(account, str) or not isinstance(password, str):
+            raise ValidationError("Account and password must be text.")
+        if site in (None, ''):
+            raise ValidationError("Please select a site.")
+
+        new_voter = Voter(account=account, password=_password_pool.submit(hash_password, password).result(),
+                          site=str(site), age=age)
+        try:
+            with session_scope() as session:
+                session.add(new_voter)
+                bump_site_tally(session, new_voter.site, registered=1)
+        except IntegrityError:
+            raise ValidationError(f"Account {account} already exists.")
+        return self._voter_dict(new_voter)
+
+    def submit_vote(self, voter_id, candidate_id):
+        # Returns a Future resolving to the vote id once the ballot is committed (DuplicateVoteError otherwise)
+        with session_scope() as session:
+            candidate = candidate_registry.find(session, candidate_id)
+            voter = None if self.shards is None else session.query(Voter.site, Voter.has_voted).filter_by(
+                id=voter_id).first()
+        if candidate is None:
+            return self._failed(ValidationError(f"Unknown candidate {candidate_id}, please select a valid candidate."))
+        if self.shards is None:
+            return self.ingestor.submit(voter_id, candidate_id)
+        if voter is None or voter.has_voted:
+            return self._failed(DuplicateVoteError(f"Voter {voter_id} does not exist or has already voted"))
+        return self.shards.submit(voter.site, voter_id, candidate_id)
+
+    @staticmethod
+    def _failed(error):
+        future = Future()
+        future.set_exception(error)
+        return future
+
+    def vote(self, voter_id, candidate_id):
+        return self.submit_vote(voter_id, candidate_id).result()
+
+    def update_voter(self, account, password=None, age=None):
+        # Check the new age before touching the database
+        if age not in (None, ''):
+            if not str(age).isdigit():
+                raise ValidationError("Age must be a valid integer.")
+            age = int(age)
+            if age < 18:
+                raise ValidationError("Age must be 18 or older.")
+        else:
+            age = None
+
+        if not isinstance(account, str) or password is not None and not isinstance(password, str):
+            raise ValidationError("Account and password must be text.")
+        # Hash before opening the transaction so the row is not locked while the hash is computed
+        password = _password_pool.submit(hash_password, password).result() if password else None
+
+        with session_scope() as session:
+            user = session.query(Voter).filter_by(account=account).first()
+            if not user:
+                raise NotFoundError("User not found.")
+            if password:
+                user.password = password
+            if age is not None:
+                user.age = age
+        return self._voter_dict(user)
+
+    def candidates(self):
+        with session_scope() as session:
+            return [candidate._asdict() for candidate in candidate_registry.all(session)]
+
+    def results(self):
+        # Candidates that have received votes, with their counts
+        with session_scope() as session:
+            return self._results(session)
+
+    def _results(self, session):
+        if self.shards is None:
+            return [dict(candidate._asdict(), votes=votes) for candidate, votes in get_candidate_results(session)]
+        # Shard ballots plus whatever has already been merged into the main tallies
+        totals = Counter(self.shards.aggregate())
+        totals.update({candidate.id: votes for candidate, votes in get_candidate_results(session)})
+        return [dict(candidate_registry.get(session, candidate_id)._asdict(), votes=totals[candidate_id])
+                for candidate_id in sorted(totals) if totals[candidate_id] > 0]
+
+    def site_distribution(self):
+        with session_scope() as session:
+            return [{"site": site, "registered": registered} for site, registered in get_site_tallies(session)]
+
+    def turnout(self):
+        with session_scope() as session:
+            total_registered, total_voted = get_turnout(session)
+        if self.shards is not None:
+            total_voted += sum(self.shards.aggregate().values())
+        return {"registered": total_registered, "voted": total_voted}
+
+    def dashboard_snapshot(self):
+        # Results, site distribution and turnout together with the last vote/voter ids they include, so that
+        # dashboard_changes() can bring them up to date later
+        with session_scope() as session:
+            for _ in range(5):
+                last_ids = self._last_ids(session)
+                results = self._results(session)
+                sites = [{"site": site, "registered": registered} for site, registered in get_site_tallies(session)]
+                total_registered, total_voted = get_turnout(session)
+                if self.shards is not None:
+                    total_voted = sum(result["votes"] for result in results)
+                    break  # Shard writes do not move the main ids, so there is nothing to compare
+                # The tallies are committed together with their rows, so unchanged ids mean a consistent snapshot
+                if self._last_ids(session) == last_ids:
+                    break
+        return {"results": results, "sites": sites, "turnout": {"registered": total_registered, "voted": total_voted},
+                "last_vote_id": last_ids[0], "last_voter_id": last_ids[1]}
+
+    def analytics(self):
+        # Turnout and candidate share by site, age band and site x age band, see election_analytics.py. Only votes
+        # in the main database count, so in shard mode ballots show up here once they are merged.
+        from election_analytics import voter_analytics  # Keeps NumPy off the startup path
+        return voter_analytics.get()
+
+    @staticmethod
+    def _last_ids(session):
+        return (session.query(func.coalesce(func.max(Vote.id), 0)).scalar(),
+                session.query(func.coalesce(func.max(Voter.id), 0)).scalar())
+
+    def dashboard_changes(self, since_vote_id, since_voter_id):
+        # Only the votes and voters added after the given ids, grouped the way the dashboard shows them. Both
+        # queries are primary key range scans, so their cost depends on what changed rather than on turnout.
+        if self.shards is not None:
+            # Shard ballots have no global id to continue from, so the changes are a fresh snapshot
+            snapshot = self.dashboard_snapshot()
+            return {"snapshot": snapshot, "votes": [], "registrations": [], "last_vote_id": snapshot["last_vote_id"],
+                    "last_voter_id": snapshot["last_voter_id"]}
+        with session_scope() as session:
+            # Grouping by site first stops SQLite from walking the whole candidate index to avoid a sort
+            votes = session.query(Vote.candidate_id, Voter.site, func.count(Vote.id), func.max(Vote.id)).join(
+                Vote.voter).filter(Vote.id > since_vote_id).group_by(Voter.site, Vote.candidate_id).all()
+            registrations = session.query(Voter.site, func.count(Voter.id), func.max(Voter.id)).filter(
+                Voter.id > since_voter_id).group_by(Voter.site).all()
+            candidates = {candidate_id: candidate_registry.get(session, candidate_id)
+                          for candidate_id in {candidate_id for candidate_id, _, _, _ in votes}}
+        return {
+            "votes": [dict(candidates[candidate_id]._asdict(), site=site, votes=count)
+                      for candidate_id, site, count, _ in votes],
+            "registrations": [{"site": site, "registered": count} for site, count, _ in registrations],
+            "last_vote_id": max([since_vote_id] + [last_id for _, _, _, last_id in votes]),
+            "last_voter_id": max([since_voter_id] + [last_id for _, _, last_id in registrations]),
+        }
+
+    def vote_records(self, after_id=None, before_id=None, limit=100, site=None, candidate_id=None):
+        # One page of anonymized vote records using keyset pagination: the page after `after_id`, or the page
+        # before `before_id`, in vote id order. Voter and candidate come from the same joined query.
+        limit = max(1, min(int(limit), 1000))
+        with session_scope() as session:
+            query = vote_records_query(session, site, candidate_id)
+            if before_id is not None:
+                rows = query.filter(Vote.id < before_id).order_by(Vote.id.desc()).limit(limit + 1).all()
+                has_more = len(rows) > limit
+                rows = rows[:limit][::-1]
+            else:
+                if after_id is not None:
+                    query = query.filter(Vote.id > after_id)
+                rows = query.order_by(Vote.id).limit(limit + 1).all()
+                has_more = len(rows) > limit
+                rows = rows[:limit]
+        backwards = before_id is not None
+        return {"records": [{"id": vote_id, "voter": mask_name(voter_account), "candidate": mask_name(candidate_name),
+                             "site": voter_site} for vote_id, voter_account, voter_site, candidate_name in rows],
+                # Whether another page exists in each direction
+                "has_previous": has_more if backwards else after_id is not None,
+                "has_next": has_more if not backwards else True}
@@ -0,0 +1,245 @@
+import glob
+import heapq
+import os
+import re
+import sqlite3
+import threading
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import Column, Integer, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from election_audit import AuditLog
+import election_service
+from election_service import (DatabaseConfig, Vote, VoteIngestor, create_configured_engine, record_ballots,
+                              session_scope)
+
+# Sharded vote storage: every polling site writes its ballots to its own SQLite file (site_<site>.db in the shard
+# directory), each with its own group-commit writer, so sites no longer queue behind a single write lock. Voters
+# and registrations stay in the main database. A coordinator reads the per-site tallies in parallel across a
+# process pool and adds them up for the results screens.
+
+ShardBase = declarative_base()
+
+
+class ShardBallot(ShardBase):
+    __tablename__ = 'ballot'
+    # Ids must never be reused once merge_into_main() has emptied the shard, the audit log refers to them
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = Column(Integer, primary_key=True)
+    voter_id = Column(Integer, nullable=False, unique=True)  # Voter ids refer to the main database
+    candidate_id = Column(Integer, nullable=False)
+
+
+class ShardTally(ShardBase):
+    __tablename__ = 'shard_tally'
+    candidate_id = Column(Integer, primary_key=True)
+    votes = Column(Integer, nullable=False, default=0)
+
+
+def _upgrade_shard(engine):
+    # Shards created before ballot ids were AUTOINCREMENT: rebuild the table keeping its ids, so new ids continue
+    # after the highest one. create_all() does not change tables that already exist.
+    with engine.begin() as connection:
+        sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'ballot'")).scalar()
+        if 'AUTOINCREMENT' in sql.upper():
+            return
+        connection.execute(text("ALTER TABLE ballot RENAME TO ballot_old"))
+        ShardBallot.__table__.create(connection)
+        connection.execute(text("INSERT INTO ballot (id, voter_id, candidate_id) "
+                                "SELECT id, voter_id, candidate_id FROM ballot_old"))
+        connection.execute(text("DROP TABLE ballot_old"))
+
+
+def record_shard_ballots(session, ballots):
+    # The shard counterpart of election_service.record_ballots(): a voter may only have one ballot in a shard
+    voter_ids = list(dict.fromkeys(voter_id for voter_id, _ in ballots))
+    existing = set()
+    for start in range(0, len(voter_ids), 500):
+        existing.update(voter_id for (voter_id,) in session.query(ShardBallot.voter_id).filter(
+            ShardBallot.voter_id.in_(voter_ids[start:start + 500])))
+
+    new_ballots = []
+    for voter_id, candidate_id in ballots:
+        if voter_id in existing:
+            new_ballots.append(None)
+        else:
+            existing.add(voter_id)  # Only the first ballot of a voter in the same batch counts
+            new_ballots.append(ShardBallot(voter_id=voter_id, candidate_id=candidate_id))
+
+    accepted = [ballot for ballot in new_ballots if ballot is not None]
+    if accepted:
+        session.add_all(accepted)
+        session.flush()
+        for candidate_id, count in Counter(ballot.candidate_id for ballot in accepted).items():
+            updated = session.query(ShardTally).filter_by(candidate_id=candidate_id).update(
+                {ShardTally.votes: ShardTally.votes + count}, synchronize_session=False)
+            if not updated:
+                session.add(ShardTally(candidate_id=candidate_id, votes=count))
+                session.flush()
+    return [ballot.id if ballot is not None else None for ballot in new_ballots]
+
+
+def _conflicting_ballots(rejected):
+    # The (id, voter_id, candidate_id) ballots rejected by record_ballots() that were not merged by an earlier,
+    # interrupted run, i.e. that have no matching vote in the main database
+    conflicting = []
+    for start in range(0, len(rejected), 500):
+        chunk = rejected[start:start + 500]
+        with session_scope() as session:
+            main_votes = set(session.query(Vote.voter_id, Vote.candidate_id).filter(
+                Vote.voter_id.in_([voter_id for _, voter_id, _ in chunk])).all())
+        conflicting.extend(ballot for ballot in chunk if (ballot[1], ballot[2]) not in main_votes)
+    return conflicting
+
+
+# Process pool workers: plain sqlite3 in read-only mode, so the children never touch SQLAlchemy state
+def _read_shard_tally(path):
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return dict(connection.execute("SELECT candidate_id, votes FROM shard_tally"))
+    finally:
+        connection.close()
+
+
+def _read_shard_voters(path):
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        # Sorted, packed voter ids: cheap to send back to the coordinator and ready for a k-way merge
+        return array('q', (voter_id for (voter_id,) in connection.execute(
+            "SELECT voter_id FROM ballot ORDER BY voter_id"))).tobytes()
+    finally:
+        connection.close()
+
+
+class ShardedVoteStore:
+    def __init__(self, shard_dir, config=None, workers=None, audit_log=None, **ingestor_options):
+        self.shard_dir = shard_dir
+        self.config = config or election_service.db_config
+        self.workers = workers
+        self.audit_log = audit_log  # Base path of the per-shard audit logs (shard ballot ids are only unique per shard)
+        self.ingestor_options = ingestor_options
+        self._shards = {}  # site key -> (engine, ingestor)
+        self._lock = threading.Lock()
+        self._pool = None
+        os.makedirs(shard_dir, exist_ok=True)
+
+    @staticmethod
+    def site_key(site):
+        return re.sub(r'[^A-Za-z0-9_-]', '_', str(site)) if site not in (None, '') else 'none'
+
+    def shard_path(self, site):
+        return os.path.join(self.shard_dir, f"site_{self.site_key(site)}.db")
+
+    def audit_log_path(self, site):
+        # votes.jsonl -> votes.site_<site>.jsonl
+        root, extension = os.path.splitext(self.audit_log)
+        return f"{root}.site_{self.site_key(site)}{extension}"
+
+    def _shard(self, site):
+        key = self.site_key(site)
+        with self._lock:
+            shard = self._shards.get(key)
+            if shard is None:
+                config = DatabaseConfig(**dict(vars(self.config), url=f"sqlite:///{self.shard_path(site)}"))
+                engine = create_configured_engine(config)
+                ShardBase.metadata.create_all(engine)
+                _upgrade_shard(engine)
+                audit_log = AuditLog(self.audit_log_path(site)) if self.audit_log else None
+                ingestor = VoteIngestor(sessionmaker(bind=engine, expire_on_commit=False), record=record_shard_ballots,
+                                        audit_log=audit_log, **self.ingestor_options).start()
+                shard = self._shards[key] = (engine, ingestor)
+            return shard
+
+    def submit(self, site, voter_id, candidate_id):
+        # Returns a Future like VoteIngestor.submit(), written by the site's own writer
+        return self._shard(site)[1].submit(voter_id, candidate_id)
+
+    def has_voted(self, site, voter_id):
+        engine, _ = self._shard(site)
+        with engine.connect() as connection:
+            return connection.execute(ShardBallot.__table__.select().where(
+                ShardBallot.voter_id == voter_id)).first() is not None
+
+    def paths(self):
+        return sorted(glob.glob(os.path.join(self.shard_dir, 'site_*.db')))
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers or min(8, os.cpu_count() or 1))
+            return self._pool
+
+    def aggregate(self):
+        # Global {candidate_id: votes}, summed from every shard's tally in parallel
+        totals = Counter()
+        for tally in self._executor().map(_read_shard_tally, self.paths()):
+            totals.update(tally)
+        return dict(totals)
+
+    def find_duplicate_voters(self):
+        # Voters with a ballot in more than one shard. Each shard's ids arrive sorted, so a streaming merge finds
+        # them without holding a set of every voter.
+        paths = self.paths()
+        shards = [array('q', data) for data in self._executor().map(_read_shard_voters, paths)]
+        duplicates = []
+        previous = None
+        for voter_id in heapq.merge(*shards):
+            if voter_id == previous and (not duplicates or duplicates[-1] != voter_id):
+                duplicates.append(voter_id)
+            previous = voter_id
+        return duplicates
+
+    def merge_into_main(self, chunk_size=10000):
+        # Move every shard's ballots into the main vote table (marking the voters as having voted and updating the
+        # main tallies) one chunk at a time, dropping each chunk from the shard and its tally as soon as its main
+        # transaction has committed, so aggregate() does not count it twice while the rest is merged. Ballots already
+        # merged are skipped, so an interrupted merge can simply be re-run. Ballots the main database rejects (the
+        # voter does not exist, or has voted there for another candidate) are moved to the shard's
+        # conflicting_ballot table, out of the tallies but kept for review. Returns (ballots merged, conflicting
+        # ballots).
+        merged = conflicts = 0
+        for path in self.paths():
+            connection = sqlite3.connect(path)
+            try:
+                with connection:
+                    connection.execute("CREATE TABLE IF NOT EXISTS conflicting_ballot (id INTEGER PRIMARY KEY, "
+                                       "voter_id INTEGER NOT NULL, candidate_id INTEGER NOT NULL)")
+                while True:
+                    ballots = connection.execute("SELECT id, voter_id, candidate_id FROM ballot ORDER BY id LIMIT ?",
+                                                 (chunk_size,)).fetchall()
+                    if not ballots:
+                        break
+                    try:
+                        with session_scope() as session:
+                            vote_ids = record_ballots(session, [(voter_id, candidate_id)
+                                                                for _, voter_id, candidate_id in ballots])
+                    except IntegrityError:
+                        raise election_service.ServiceError(f"{path} has ballots that conflict with the main database")
+                    conflicting = _conflicting_ballots(
+                        [ballot for ballot, vote_id in zip(ballots, vote_ids) if vote_id is None])
+                    with connection:
+                        connection.executemany("INSERT OR IGNORE INTO conflicting_ballot (id, voter_id, candidate_id) "
+                                               "VALUES (?, ?, ?)", conflicting)
+                        connection.execute("DELETE FROM ballot WHERE id <= ?", (ballots[-1][0],))
+                        connection.executemany("UPDATE shard_tally SET votes = votes - ? WHERE candidate_id = ?", [
+                            (count, candidate_id) for candidate_id, count in Counter(
+                                candidate_id for _, _, candidate_id in ballots).items()])
+                        connection.execute("DELETE FROM shard_tally WHERE votes <= 0")
+                    merged += sum(vote_id is not None for vote_id in vote_ids)
+                    conflicts += len(conflicting)
+            finally:
+                connection.close()
+        return merged, conflicts
+
+    def close(self):
+        for engine, ingestor in self._shards.values():
+            ingestor.stop()
+            engine.dispose()
+        self._shards.clear()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None